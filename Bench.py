@@ -0,0 +1,185 @@
+import Core
+from Core import *
+from Parser import file_parse, parse_term
+from Checker import Checker, BUILTINS
+import Check
+import json
+import sys
+import time
+import tracemalloc
+"""
+Benchmarks on generated workloads.
+
+Each workload generates the source of a .hott file of size n, together with
+a term to normalize and a pair of terms that are convertible at a type.
+The phases parse, infer, normalize, Check.normalize and conversion are run
+on it, and their wall time, peak memory and operation counts are reported
+as JSON.
+
+Every workload is run twice from empty hash-consing tables, once for the
+time and once under tracemalloc for the memory, which slows it down.
+"""
+
+NAT = "Π (A : U) (s : Π (a : A) => A) (z : A) => A"
+
+def church(n):
+    """
+    Church numerals of size n, normalizing and comparing n + n with 2n.
+    """
+    def numeral(k):
+        return "λ (A : U) (s : Π (a : A) => A) (z : A) => " + "s (" * k + "z" + ")" * k
+    source = "\n".join((
+        "\\define Nat " + NAT,
+        "\\define add λ (m : Nat) (n : Nat) (A : U) (s : Π (a : A) => A) (z : A) "
+            "=> m A s (n A s z)",
+        "\\define n " + numeral(n),
+        "\\define twice " + numeral(2 * n),
+        "\\infer add n n"))
+    return source, "add n n", ("add n n", "twice", "Nat")
+
+def telescope(n):
+    """
+    A function with a Π telescope of depth n, compared with the same
+    telescope over a definition of U.
+    """
+    binders = "".join(" (x%d : A)" % k for k in range(n))
+    source = "\n".join((
+        "\\define T U",
+        "\\define f λ (A : U)%s => x0" % binders,
+        "\\infer f"))
+    ty = "Π (A : U)%s => A" % binders
+    return source, "f", (ty, ty.replace("(A : U)", "(A : T)"), "U")
+
+def chain(n):
+    """
+    n definitions, each one using the one before.
+    """
+    lines = ["\\define d0 λ (A : U) (x : A) => x"]
+    lines += ["\\define d%d λ (A : U) (x : A) => d%d A x" % (k, k - 1) for k in range(1, n)]
+    lines.append("\\infer d%d" % (n - 1))
+    target = "d%d U U" % (n - 1)
+    return "\n".join(lines), target, (target, "U", "U")
+
+def cube(n):
+    """
+    n-ary ap and Id over a telescope of n copies of p.
+    """
+    tele = " ; ".join("x%d / p : a == b" % k for k in range(n))
+    ctx = "λ (A : U) (a : A) (b : A) (p : Id[.A][a,b]) => "
+    source = "\n".join((
+        "\\define ap%d %sap[%s . x0]" % (n, ctx, tele),
+        "\\define Id%d %sId[%s . Id[.A][x0, x%d]][ap[.a], ap[.b]]" % (n, ctx, tele, n - 1),
+        "\\infer ap%d" % n,
+        "\\infer Id%d" % n))
+    return source, "Id%d" % n, ("Id%d" % n, ctx + "Id%d A a b p" % n,
+        "Π (A : U) (a : A) (b : A) (p : Id[.A][a,b]) => U")
+
+def sigma(n):
+    """
+    A pair nested n wide, of type Σ (x1 : A) ... (xn : A) => A.
+    """
+    def ty(k):
+        return "Σ" + "".join(" (x%d : A)" % j for j in range(k)) + " => A" if k else "A"
+    pair = "a"
+    for k in range(1, n + 1):
+        pair = "a { x => %s } (%s)" % (ty(k - 1), pair)
+    source = "\n".join((
+        "\\define pair λ (A : U) (a : A) => " + pair,
+        "\\infer pair"))
+    return source, "pair", ("pair", "λ (A : U) (a : A) => pair A a",
+        "Π (A : U) (a : A) => " + ty(n))
+
+WORKLOADS = {"church" : church, "telescope" : telescope, "chain" : chain,
+    "cube" : cube, "sigma" : sigma}
+
+def unfold(checker, expr):
+    # Substitute the definitions into expr, for Check which has none.
+    while (defs := {x : checker.definitions[x] for x in freevar(expr)
+            if x in checker.definitions}):
+        expr = subst(expr, defs)
+    return expr
+
+def counts(checker):
+    # Running totals of the operations, phases report their differences.
+    return {
+        "rules" : sum(checker.rules.hits.values()),
+        "check_rules" : sum(Check.RULES.hits.values()),
+        "cache_hits" : checker.cache.hits,
+        "cache_misses" : checker.cache.misses,
+        "fresh" : Core.fresh,
+        "nodes" : len(Core.interned),
+    }
+
+def phases(workload, n, engine):
+    """
+    Yields the name of each phase after running it, with the checker.
+    """
+    source, target, (lhs, rhs, ty) = WORKLOADS[workload](n)
+    checker = Checker(dict(BUILTINS), engine)
+    statements = list(file_parse(source))
+    yield "parse", checker
+    for command in statements:
+        checker.execute(command)
+    yield "infer", checker
+    target = parse_term(target)
+    checker.normalize(target, True)
+    yield "normalize", checker
+    Check.normalize(unfold(checker, target))
+    yield "Check.normalize", checker
+    checker.conversion(parse_term(lhs), parse_term(rhs), parse_term(ty))
+    yield "conversion", checker
+
+def run(workload, n, engine="subst"):
+    """
+    Benchmark the phases of a workload of size n, returns a list of records.
+    """
+    records = []
+    reset_tables()
+    Check.RULES.hits.clear()
+    start = counts(Checker())
+    try:
+        before = time.perf_counter()
+        for phase, checker in phases(workload, n, engine):
+            after = time.perf_counter()
+            end = counts(checker)
+            records.append({"workload" : workload, "n" : n, "engine" : engine,
+                "phase" : phase, "time" : after - before,
+                "counts" : {k : end[k] - start[k] for k in end}})
+            start = end
+            before = time.perf_counter()
+        reset_tables()
+        tracemalloc.start()
+        for record, _ in zip(records, phases(workload, n, engine)):
+            record["peak_memory"] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.reset_peak()
+    except (RecursionError, ValueError, RuntimeError) as e:
+        records.append({"workload" : workload, "n" : n, "engine" : engine,
+            "error" : "%s: %s" % (type(e).__name__, e)})
+    finally:
+        tracemalloc.stop()
+    return records
+
+if __name__ == "__main__":
+    import argparse
+    argparser = argparse.ArgumentParser(description="Benchmarks generated workloads.")
+    argparser.add_argument("workloads", nargs="*", default=list(WORKLOADS),
+        metavar="WORKLOAD", help="one of %s (all by default)" % ", ".join(WORKLOADS))
+    argparser.add_argument("--sizes", "-n", type=int, nargs="+", default=[4, 8, 16],
+        metavar="N")
+    argparser.add_argument("--engine", choices=("subst", "nbe"), default="subst")
+    argparser.add_argument("--output", "-o", metavar="PATH",
+        help="write the JSON report to PATH instead of stdout")
+    args = argparser.parse_args()
+    for workload in args.workloads:
+        if workload not in WORKLOADS:
+            argparser.error("unknown workload: " + workload)
+    sys.setrecursionlimit(100000)
+    results = [r for workload in args.workloads for n in args.sizes
+        for r in run(workload, n, args.engine)]
+    report = {"python" : sys.version.split()[0], "results" : results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1, ensure_ascii=False)
+    else:
+        json.dump(report, sys.stdout, indent=1, ensure_ascii=False)
+        print()
@@ -0,0 +1,121 @@
+from collections import OrderedDict
+from Core import hashcons, mk
+import hashlib
+import json
+import os
+"""
+Caches for the checker.
+"""
+
+class LRU:
+    def __init__(self, maxsize=4096):
+        """
+        A mapping of at most maxsize entries (None for unbounded), which
+        evicts the least recently used entry. Lookups are counted in hits and
+        misses.
+        """
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        self.misses += 1
+        return default
+
+    def __setitem__(self, key, value):
+        if self.maxsize == 0:
+            return
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if self.maxsize is not None and len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+def _dump_terms(terms):
+    # The nodes of terms numbered bottom up, each as [tag, *items] where the
+    # items are the numbers of child nodes or the other children in a list,
+    # with the number of each term. Shared nodes are written once.
+    numbers = {}
+    nodes = []
+    roots = []
+    for term in terms:
+        stack = [term]
+        while stack:
+            t = stack[-1]
+            if id(t) in numbers:
+                stack.pop()
+                continue
+            n = len(stack)
+            stack.extend(c for c in reversed(t) if type(c) is tuple and id(c) not in numbers)
+            if len(stack) > n:
+                continue
+            stack.pop()
+            numbers[id(t)] = len(nodes)
+            nodes.append([t[0], *(numbers[id(c)] if type(c) is tuple else [c] for c in t[1:])])
+        roots.append(numbers[id(term)])
+    return nodes, roots
+
+def _load_terms(nodes):
+    # The canonical terms of the nodes written by _dump_terms.
+    terms = []
+    for tag, *items in nodes:
+        terms.append(mk(tag, *(terms[i] if type(i) is int else i[0] for i in items)))
+    return terms
+
+class StatementCache:
+    def __init__(self, path, salt=""):
+        """
+        Results of top level statements stored on disk at path, keyed by a
+        hash of the statement and of the keys of the statements it depends
+        on. salt describes anything else the results depend on, such as the
+        builtin constants.
+        The file is JSON, so loading it runs no code, but the results in it
+        are trusted: statements whose results are found are not checked.
+        A file that is not a cache (or an unreadable one) is started over.
+        """
+        self.path = path
+        self.salt = salt
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            terms = _load_terms(data["nodes"])
+            self.entries = {key : terms[i] for key, i in data["entries"].items()}
+        except (FileNotFoundError, ValueError, LookupError, TypeError, AttributeError):
+            self.entries = {}
+        self.used = {}  # Only the entries of the latest run are saved.
+        self.reused = 0
+        self.checked = 0
+
+    def key(self, statement, deps):
+        nodes, _ = _dump_terms([statement])  # Unlike repr, for any depth.
+        return hashlib.sha256(
+            repr((self.salt, nodes, sorted(deps))).encode()).hexdigest()
+
+    def get(self, key):
+        if key in self.entries:
+            self.reused += 1
+            return hashcons(self.entries[key])
+        self.checked += 1
+        return None
+
+    def __setitem__(self, key, result):
+        self.used[key] = result
+
+    def save(self):
+        nodes, roots = _dump_terms(self.used.values())
+        with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"nodes" : nodes, "entries" : dict(zip(self.used, roots))}, f,
+                ensure_ascii=False, separators=(",", ":"))
+        os.replace(self.path + ".tmp", self.path)
@@ -1,5 +1,6 @@
 from Core import *
 from Parser import parse, pretty
+from Rules import Rules, normal_form
 """
 ===== Core Components =====
 Π   Pi types
@@ -22,73 +23,109 @@ U   Universe (Currently spartan McBride style)
 """
 
 def fun(a, b):
-    return ("Π", a, ("Bind", "_", b))
+    return ("Π", a, bind((fresh_var("_"),), b))
 
 def pr(a, b):
-    return ("Σ", a, ("Bind", "_", b))
+    return ("Σ", a, bind((fresh_var("_"),), b))
 
 def refl(tm):
-    return ("ap", ("Bind", tm))
+    return ("ap", ("Bind", tm), ("Telescope",), ("Telescope",), ("Telescope",))
 
 def Id(ty, tm1, tm2):
-    return ("Id", ("Bind", ty), tm1, tm2)
+    return ("Id", ("Bind", ty), ("Telescope",), ("Telescope",), ("Telescope",),
+        tm1, tm2)
+
+def tele(scope):
+    """
+    Unpack the left, right and equation telescopes of an Id or ap.
+    """
+    return tuple(t[1:] for t in scope)
 
 def isContr(A):
-    return subst(("Σ", ("Var", "isContr_A"), ("Bind", "_x",
-        ("Π", ("Var", "isContr_A"), ("Bind", "_y",
-            Id(("Var", "isContr_A"), ("Var", "_x"), ("Var", "_y")))))),
-        {"isContr_A" : A})
+    x, y = fresh_var("_x"), fresh_var("_y")
+    return ("Σ", A, bind((x,),
+        ("Π", A, bind((y,),
+            Id(A, ("Var", x), ("Var", y))))))
 
 def OneOneCorr(A, B):
-    vA = ("Var", "Corr_A")
-    vB = ("Var", "Corr_B")
-    return subst(("Σ", fun(vA, fun(vB, ("U",))), ("Bind", "_R",
+    R, a, b = fresh_var("_R"), fresh_var("_a"), fresh_var("_b")
+    Rab = ("@", ("@", ("Var", R), ("Var", a)), ("Var", b))
+    return ("Σ", fun(A, fun(B, ("U",))), bind((R,),
         pr(
-            ("Π", vA, ("Bind", "_a", isContr(("Σ", vB, ("Bind", "_b", ("@", ("@", ("Var", "_R"), ("Var", "_a")), ("Var", "_b"))))))),
-            ("Π", vB, ("Bind", "_b", isContr(("Σ", vA, ("Bind", "_a", ("@", ("@", ("Var", "_R"), ("Var", "_a")), ("Var", "_b")))))))
-        ))),
-        {"Corr_A" : A, "Corr_B" : B})
+            ("Π", A, bind((a,), isContr(("Σ", B, bind((b,), Rab))))),
+            ("Π", B, bind((b,), isContr(("Σ", A, bind((a,), Rab)))))
+        )))
+
+RULES = Rules()
 
 def rewrite(tm):
+    return RULES.rewrite(tm)
+
+@RULES.register("@", "beta")
+def rule_beta(tm):
+    match tm:
+        case ("@", ("λ", _, ("Bind", _, _) as body), arg):
+            return instantiate(body, (arg,))
+
+@RULES.register("fst", "fst")
+def rule_fst(tm):
     match tm:
-        case ("@", ("λ", _, ("Bind", x, body)), arg):
-            return subst(body, {x:arg})
         case ("fst", (",", _, tm1, _)):
             return tm1
+
+@RULES.register("snd", "snd")
+def rule_snd(tm):
+    match tm:
         case ("snd", (",", _, _, tm2)):
             return tm2
-        case ("Id", ("Bind", *vars, ty), *scope, lhs, rhs):
+
+@RULES.register("Id", "Id-drop")
+def rule_Id_drop(tm):
+    match tm:
+        case ("Id", ("Bind", *xs, body) as tyfam, *scope, lhs, rhs) \
+            if xs and not occurs(body, 0):
+            # Redact the last variable, which is not used.
             left, right, eqs = tele(scope)
-            # First try to redact the last free variable.
-            if len(vars) > 0 and vars[-1] not in freevar(ty):
-                return ("Id", ("Bind", *vars[:-1], ty),
-                    *left[:-1],
-                    *right[:-1],
-                    *eqs[:-1],
-                    lhs, rhs)
-            match ty:  # Next proceed by cases.
+            vars, ty = unbind(tyfam)
+            return ("Id", bind(vars[:-1], ty),
+                ("Telescope", *left[:-1]),
+                ("Telescope", *right[:-1]),
+                ("Telescope", *eqs[:-1]),
+                lhs, rhs)
+
+@RULES.register("Id", "Id")
+def rule_Id(tm):
+    match tm:
+        case ("Id", ("Bind", *_) as tyfam, *scope, lhs, rhs):
+            left, right, eqs = tele(scope)
+            vars, ty = unbind(tyfam)
+            match ty:  # Proceed by cases.
                 # Dependent Sigma
-                case ("Σ", dom, ("Bind", x, cod)):
+                case ("Σ", dom, ("Bind", _, _) as cod):
+                    (x,), cod = unbind(cod)
                     return ("Σ",
-                        ("Id", ("Bind", *vars, dom),
+                        ("Id", bind(vars, dom),
                             *scope, ("fst", lhs), ("fst", rhs)),
-                        ("Bind", x,
-                            ("Id", ("Bind", *vars, x, cod),
-                                *left,   ("fst", lhs),
-                                *right,  ("fst", rhs),
-                                *eqs,    ("Var", x),
+                        bind((x,),
+                            ("Id", bind((*vars, x), cod),
+                                ("Telescope", *left,  ("fst", lhs)),
+                                ("Telescope", *right, ("fst", rhs)),
+                                ("Telescope", *eqs,   ("Var", x)),
                                 ("snd", lhs), ("snd", rhs))))
                 # Dependent Pi
-                case ("Π", dom, ("Bind", x, cod)):
+                case ("Π", dom, ("Bind", _, _) as cod):
+                    (x,), cod = unbind(cod)
                     u, v = fresh_var("u"), fresh_var("v")
-                    return ("Π", dom, ("Bind", u,
-                        ("Π", dom, ("Bind", v,
-                        ("Π", ("Id", ("Bind", *vars, dom),
-                            *scope, ("Var", u), ("Var", v)), ("Bind", x,
-                            ("Id", ("Bind", *vars, x, cod),
-                                *left,   ("Var", u),
-                                *right,  ("Var", v),
-                                *eqs,    ("Var", x),
+                    domfam = bind(vars, dom)
+                    ldom, rdom = instantiate_many(domfam, (left, right))
+                    return ("Π", ldom, bind((u,),
+                        ("Π", rdom, bind((v,),
+                        ("Π", ("Id", domfam,
+                            *scope, ("Var", u), ("Var", v)), bind((x,),
+                            ("Id", bind((*vars, x), cod),
+                                ("Telescope", *left,  ("Var", u)),
+                                ("Telescope", *right, ("Var", v)),
+                                ("Telescope", *eqs,   ("Var", x)),
                                 ("@", lhs, ("Var", u)),
                                 ("@", rhs, ("Var", v)))))))))
                 # 0, 1
@@ -98,101 +135,125 @@ def rewrite(tm):
                 case ("U",):
                     # It is impossible to have len(vars) > 0 here.
                     return OneOneCorr(lhs, rhs)
-        case ("ap", ("Bind", *vars, tm), *scope):
+
+@RULES.register("ap", "ap-drop")
+def rule_ap_drop(tm):
+    match tm:
+        case ("ap", ("Bind", *xs, body) as fam, *scope) \
+            if xs and not occurs(body, 0):
+            left, right, eqs = tele(scope)
+            vars, tm = unbind(fam)
+            return ("ap", bind(vars[:-1], tm),
+                ("Telescope", *left[:-1]),
+                ("Telescope", *right[:-1]),
+                ("Telescope", *eqs[:-1]))
+
+@RULES.register("ap", "ap")
+def rule_ap(tm):
+    match tm:
+        case ("ap", ("Bind", *_) as fam, *scope):
             left, right, eqs = tele(scope)
-            if len(vars) > 0 and vars[-1] not in freevar(tm):
-                return ("ap", ("Bind", *vars[:-1], tm),
-                    *left[:-1],
-                    *right[:-1],
-                    *eqs[:-1])
+            vars, tm = unbind(fam)
             match tm:
                 case ("Var", v) if v in vars:  # This happens unless we have refl.
                     return eqs[vars.index(v)]
                 # Dependent Sigma
                 case ("fst", pair):
-                    return ("fst", ("ap", ("Bind", *vars, pair), *scope))
+                    return ("fst", ("ap", bind(vars, pair), *scope))
                 case ("snd", pair):
-                    return ("snd", ("ap", ("Bind", *vars, pair), *scope))
-                case (",", ("Bind", x, wit), tm1, tm2):
-                    return (",", ("Bind", x,
-                            ("Id", ("Bind", *vars, x, wit),
-                                *left, ("fst", lhs),
-                                *right, ("fst", rhs),
-                                *eqs, ("Var", x),
-                                subst(tm2, {v:t for v,t in zip(vars, left)}),
-                                subst(tm2, {v:t for v,t in zip(vars, right)}))),
-                        ("ap", ("Bind", *vars, tm1), *scope),
-                        ("ap", ("Bind", *vars, tm2), *scope))
+                    return ("snd", ("ap", bind(vars, pair), *scope))
+                case (",", ("Bind", _, _) as wit, tm1, tm2):
+                    (x,), wit = unbind(wit)
+                    tm1fam, tm2fam = bind(vars, tm1), bind(vars, tm2)
+                    ltm1, rtm1 = instantiate_many(tm1fam, (left, right))
+                    return (",", bind((x,),
+                            ("Id", bind((*vars, x), wit),
+                                ("Telescope", *left,  ltm1),
+                                ("Telescope", *right, rtm1),
+                                ("Telescope", *eqs,   ("Var", x)),
+                                *instantiate_many(tm2fam, (left, right)))),
+                        ("ap", tm1fam, *scope),
+                        ("ap", tm2fam, *scope))
                 # Dependent Pi
-                case ("λ", dom, ("Bind", x, tm)):
-                    u,v = fresh_var("u"), fresh_var("v")
-                    return ("λ", dom, ("Bind", u,
-                        ("λ", dom, ("Bind", v,
-                        ("λ", ("Id", ("Bind", *vars, dom),
-                            *scope, ("Var", u), ("Var", v)), ("Bind", x,
-                            ("ap", ("Bind", *vars, x, tm),
-                                *left, ("Var", u),
-                                *right, ("Var", v),
-                                *eqs, ("Var", x))))))))
+                case ("λ", dom, ("Bind", _, _) as body):
+                    (x,), tm = unbind(body)
+                    u, v = fresh_var("u"), fresh_var("v")
+                    domfam = bind(vars, dom)
+                    ldom, rdom = instantiate_many(domfam, (left, right))
+                    return ("λ", ldom, bind((u,),
+                        ("λ", rdom, bind((v,),
+                        ("λ", ("Id", domfam,
+                            *scope, ("Var", u), ("Var", v)), bind((x,),
+                            ("ap", bind((*vars, x), tm),
+                                ("Telescope", *left,  ("Var", u)),
+                                ("Telescope", *right, ("Var", v)),
+                                ("Telescope", *eqs,   ("Var", x)))))))))
                 case ("@", fun, arg):
+                    argfam = bind(vars, arg)
+                    larg, rarg = instantiate_many(argfam, (left, right))
                     return ("@", ("@", ("@",
-                        ("ap", ("Bind", *vars, fun), *scope),
-                        subst(arg, {v:t for v,t in zip(vars, left)})),
-                        subst(arg, {v:t for v,t in zip(vars, right)})),
-                        ("ap", ("Bind", *vars, arg), *scope))
+                        ("ap", bind(vars, fun), *scope),
+                        larg), rarg),
+                        ("ap", argfam, *scope))
                 # 0, 1
                 case ("cons", "*"):
                     return ("cons", "*")
 
+def whnf(tm):
+    """
+    Reduce tm only until its head is exposed, leaving the arguments alone.
+    The type family of Id and the body of ap are the heads here.
+    """
+    while True:
+        match tm:
+            case ("@", fun, arg):
+                tm = ("@", whnf(fun), arg)
+            case (("fst" | "snd") as head, pair):
+                tm = (head, whnf(pair))
+            case (("Id" | "ap") as head, ("Bind", *xs, body), *rest):
+                tm = (head, ("Bind", *xs, whnf(body)), *rest)
+        if (tmr := rewrite(tm)) is None:
+            return tm
+        tm = tmr
+
 def normalize_(tm):
-    touched = False
-    tmr = []
-    for sub in tm:
-        if isinstance(sub, tuple):
-            subr, t = normalize_(sub)
-            tmr.append(subr)
-            touched = touched or t
-        else:
-            tmr.append(sub)
-    tm = tuple(tmr)
-
-    tmr = rewrite(tm)
-    if tmr is None:
-        if touched:
-            return normalize_(tm)[0], True
-        return tm, False
-    return normalize_(tmr)[0], True
+    tm = hashcons(tm)
+    nf = normal_form(tm, rewrite)
+    return nf, nf is not tm
 
 def normalize(tm):
-    return normalize_(tm)[0]
+    return normal_form(hashcons(tm), rewrite)
 
 def conv(tm1, tm2, ty):
     # Checks whether tm1 <=> tm2.
     if alpha(tm1, tm2): return
-    match ty := normalize(ty):
+    match ty := whnf(ty):
         case ("U",):
-            match tm1 := normalize(tm1), tm2 := normalize(tm2):
-                case _ if tm1 == tm2: return
-                case ("Π", dom1, ("Bind", x1, cod1)),\
-                    ("Π", dom2, ("Bind", x2, cod2)):
+            match tm1 := whnf(tm1), tm2 := whnf(tm2):
+                case _ if alpha(tm1, tm2): return
+                case ("Π", dom1, ("Bind", _, _) as cod1),\
+                    ("Π", dom2, ("Bind", _, _) as cod2):
                     conv(dom1, dom2, ("U",))
-                    conv(cod1, subst(cod2,{x2:("Var",x1)}), ("U",))
-                case ("Σ", dom1, ("Bind", x1, cod1)),\
-                    ("Σ", dom2, ("Bind", x2, cod2)):
+                    (x1,), cod1 = unbind(cod1)
+                    conv(cod1, instantiate(cod2, (("Var",x1),)), ("U",))
+                case ("Σ", dom1, ("Bind", _, _) as cod1),\
+                    ("Σ", dom2, ("Bind", _, _) as cod2):
                     conv(dom1, dom2, ("U",))
-                    conv(cod1, subst(cod2,{x2:("Var",x1)}), ("U",))
+                    (x1,), cod1 = unbind(cod1)
+                    conv(cod1, instantiate(cod2, (("Var",x1),)), ("U",))
+                case _ if alpha(normalize(tm1), normalize(tm2)): return
                 case _:
                     raise ValueError("Type mismatch.", pretty(tm1), pretty(tm2))
-        case ("Π", _, ("Bind", x, cod)):
-            x = fresh_var(x)
+        case ("Π", _, ("Bind", _, _) as cod):
+            (x,), cod = unbind(cod)
             conv(normalize(("@",tm1,("Var",x))),
                 normalize(("@",tm2,("Var",x))), cod)
-        case ("Σ", dom, ("Bind", x, cod)):
+        case ("Σ", dom, ("Bind", _, _) as cod):
             nfsttm1 = normalize(("fst", tm1))
             conv(nfsttm1,
                 normalize(("fst", tm2)), dom)
             conv(normalize(("snd", tm1)),
-                normalize(("snd", tm2)), subst(cod, {x:nfsttm1}))
+                normalize(("snd", tm2)), instantiate(cod, (nfsttm1,)))
         case ("cons", ("0" | "1")):
             return
         case _:
@@ -201,19 +262,19 @@ def conv(tm1, tm2, ty):
 def ensureΠΣ(con, ty):
     """
     Ensures that the type is a function type or a dependent pair.
-    Returns (dom, x, cod).
+    Returns (dom, cod), where cod binds one variable.
     """
-    match ty := normalize(ty):
-        case (c, dom, ("Bind", x, cod)) if c == con:
-            return dom, x, cod
+    match ty := whnf(ty):
+        case (c, dom, ("Bind", _, _) as cod) if c == con:
+            return dom, cod
         case _:
             raise ValueError(f"Not a {con} type.", pretty(ty))
 
 # Global constants.
 constants = dict()
 constants["0"] = ("U",)
-constants["absurd"] = ("Π", ("0",), ("Bind", "_",
-    ("Π", ("U",), ("Bind", "T", ("Var", "T")))))
+constants["absurd"] = to_nameless(("Π", ("0",), ("Bind", "_",
+    ("Π", ("U",), ("Bind", "T", ("Var", "T"))))))
 constants["1"] = ("U",)
 constants["*"] = ("con", "1")
 
@@ -1,199 +1,517 @@
 from Core import *
 from Parser import pretty, file_parse
+from Cache import LRU
+from Persistent import Map
+from Rules import Rules, pattern_rule, normal_form
+import NbE
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from contextlib import contextmanager
+from itertools import count
+import copy
+
+BUILTINS = {
+    "0" : ("U",),
+    "1" : ("U",),
+    "*" : ("con", "1"),
+    "absurd" : to_nameless(("Π", ("0",), ("Bind", "_", ("Π", ("U",), ("Bind", "T", ("Var", "T"))))))
+}
+
+class Undecided(ValueError):
+    """
+    A conversion problem expr1 = expr2 : ty in context that could neither be
+    solved nor refuted.
+    """
+    def __init__(self, expr1, expr2, ty, context):
+        super().__init__(expr1, expr2, ty, context)
+        self.expr1, self.expr2, self.ty, self.context = expr1, expr2, ty, context
+
+    def __str__(self):
+        return "Cannot decide " + pretty(self.expr1) + " = " + pretty(self.expr2) \
+            + " : " + pretty(self.ty)
+
+# The tables of a checker at some point, see Checker.snapshot.
+Snapshot = namedtuple("Snapshot",
+    ("context", "definitions", "deftypes", "constants", "rules", "user_rules", "version"))
+
+def stuck(expr):
+    """
+    Whether the spine of expr is headed by Id, ap, trR or fillR.
+    """
+    while expr[0] in ("@", "fst", "snd"):
+        expr = expr[1]
+    return expr[0] in ("Id", "ap", "trR", "fillR")
+
+RULES = Rules()  # The builtin rules, each checker starts with a copy.
+
+@RULES.register("Var", "delta")
+def rule_delta(expr, checker, unfold):
+    return checker.delta(expr[1], unfold)
+
+@RULES.register("@", "beta")
+def rule_beta(expr, checker, unfold):
+    match expr:
+        case ("@", ("λ", _, ("Bind", _, _) as body), arg):
+            return instantiate(body, (arg,))
+
+@RULES.register("fst", "fst")
+def rule_fst(expr, checker, unfold):
+    match expr:
+        case ("fst", (",", _, fst, _)):
+            return fst
+
+@RULES.register("snd", "snd")
+def rule_snd(expr, checker, unfold):
+    match expr:
+        case ("snd", (",", _, _, snd)):
+            return snd
+
+@RULES.register("Id", "Id-drop")
+@RULES.register("ap", "ap-drop")
+def rule_drop(expr, checker, unfold):
+    match expr:
+        case (head, ("Bind", *xs, body) as fam,
+            ("Telescope", *left),
+            ("Telescope", *right),
+            ("Telescope", *eqs), *ends) if xs and not occurs(body, 0):
+            # The last variable of the telescope is not used.
+            vars, body = unbind(fam)
+            return (head, bind(vars[:-1], body),
+                ("Telescope", *left[:-1]),
+                ("Telescope", *right[:-1]),
+                ("Telescope", *eqs[:-1]), *ends)
 
 class Checker:
-    def __init__(self, constants=None):
+    def __init__(self, constants=None, engine="subst", cache_size=4096, strict=False):
         """
-        Builtin constants are passed in as a dictionary.
-        Rewrite rules are passed in as a function.
+        Builtin constants are passed in as a mapping.
+        Rewrite rules start out as the builtin RULES, see add_rule.
+        The normalization engine is either "subst" (rewriting) or "nbe".
+        Normal forms are cached, at most cache_size of them.
+        Conversion problems that cannot be decided are collected in postponed,
+        or fail if strict is set.
+        The context, definitions, constants and rules are replaced rather
+        than changed (the tables are persistent maps), see snapshot.
         """
-        self.constants = constants or {}
-        self.definitions = {}
-        self.context = {}
+        if engine not in ("subst", "nbe"):
+            raise ValueError("Unknown engine: " + engine)
+        self.engine = engine
+        self.constants = Map(constants or {})
+        self.definitions = Map()
+        self.deftypes = Map()  # The checked type of each definition.
+        self.context = Map()
+        self.strict = strict
+        self.postponed = []
+        self.rules = RULES.copy()
+        self.user_rules = ()
+        # Normal forms are cached per version of the definitions, constants
+        # and rules, which must be changed through define, declare, add_rule
+        # and restore.
+        self.cache = LRU(cache_size)
+        self.versions = count()
+        self.version = next(self.versions)
+
+    def snapshot(self):
+        """
+        The current context, definitions, constants and rules, with the
+        version they are cached under, in constant time. Later changes to the
+        checker do not affect it.
+        """
+        return Snapshot(self.context, self.definitions, self.deftypes, self.constants,
+            self.rules, self.user_rules, self.version)
+
+    def restore(self, snapshot):
+        """
+        Go back to the tables of snapshot, and so to the normal forms cached
+        for them.
+        """
+        (self.context, self.definitions, self.deftypes, self.constants,
+            self.rules, self.user_rules, self.version) = snapshot
+
+    def at(self, snapshot):
+        """
+        A checker working in snapshot, which shares everything else with this
+        one: the caches, rule hit counts and postponed problems. Checking in
+        it leaves this checker as it is, e.g. to check subgoals speculatively
+        or on other threads (the caches are shared without locking).
+        """
+        checker = copy.copy(self)
+        checker.restore(snapshot)
+        return checker
 
     @contextmanager
     def push(self, ctx:dict):
         """
-        Pushes in a context of variables. The shadowed variables will be
-        restored after the context is exited.
-        """
-        shadowed = {}
-        for k, v in ctx.items():
-            if k in self.context:
-                shadowed[k] = self.context[k]
-            self.context[k] = v
-        yield
-        for k in ctx:
-            if k in shadowed:
-                self.context[k] = shadowed[k]
-            else:
-                del self.context[k]
+        Pushes in a context of variables. The previous context is restored
+        after the context is exited.
+        """
+        context = self.context
+        self.context = context.update(ctx)
+        try:
+            yield
+        finally:
+            self.context = context
 
     @contextmanager
     def push_def(self, ctx:dict):
-        shadowed = {}
-        for k, v in ctx.items():
-            if k in self.definitions:
-                shadowed[k] = self.context[k]
-            self.definitions[k] = v
-        yield
-        for k in ctx:
-            if k in shadowed:
-                self.definitions[k] = shadowed[k]
-            else:
-                del self.definitions[k]
+        """
+        Pushes in definitions, checking each body once. The previous
+        definitions and their types are restored after the context is exited.
+        """
+        snapshot = self.snapshot()
+        try:
+            for k, v in ctx.items():
+                ty = self.infer(v)
+                self.deftypes = self.deftypes.set(k, ty)
+                self.definitions = self.definitions.set(k, v)
+                self.version = next(self.versions)
+            yield
+        finally:
+            self.restore(snapshot)  # The tables are as they were before.
 
-    def rewrite(self, expr):
-        match expr:
-            case ("Var", x):
-                if x not in self.context:
-                    if x in self.definitions:
-                        return self.definitions[x]
-                    elif x in self.constants:
-                        return ("con", x)
-            case ("@", ("λ", _, ("Bind", x, body)), arg):
-                return subst(body, {x:arg})
-            case ("fst", (",", _, fst, _)):
-                return fst
-            case ("snd", (",", _, _, snd)):
-                return snd
-
-    def _normalize(self, expr):  # Brutal CBV
+    def define(self, name, body, ty=None):
+        """
+        Checks the body of a definition once and records its type.
+        A type that is already known to be correct skips the checking.
+        """
+        if ty is None:
+            ty = self.infer(body)
+        self.definitions = self.definitions.set(name, body)
+        self.deftypes = self.deftypes.set(name, ty)
+        self.version = next(self.versions)
+        return ty
+
+    def declare(self, name, ty, checked=False):
+        """
+        Adds a constant of type ty.
+        """
+        if not checked:
+            self.check(ty, ("U",))
+        self.constants = self.constants.set(name, ty)
+        self.version = next(self.versions)
+
+    def add_rule(self, name, types, lhs, rhs, checked=False):
+        """
+        Adds the rule rewriting lhs into rhs. lhs and rhs are Binds over
+        pattern variables whose types are in the Telescope types, each
+        under the ones before it. Both sides must have the same type.
+        Returns the type, bound over the pattern variables.
+        """
+        vars, lbody = unbind(lhs)
+        ctx = {}
+        for k, v in enumerate(vars):
+            ctx[v] = instantiate(mk("Bind", *vars[:k], types[k + 1]), [("Var", x) for x in vars[:k]])
+        if not checked:
+            missing = set(range(len(vars))) - {i for i in range(len(vars)) if occurs(lhs[-1], i)}
+            if missing:
+                raise ValueError("Pattern variable does not occur in the left hand side: " +
+                    ", ".join(lhs[-2 - i] for i in sorted(missing)))
+            if lhs[-1][0] == "Idx":
+                raise ValueError("The left hand side of a rule cannot be a pattern variable")
+            if lhs[-1][0] == "Var" and lhs[-1][1] not in self.constants:
+                raise ValueError("The left hand side of a rule must be a constant here: " +
+                    lhs[-1][1])
+        with self.push(ctx):
+            if not checked:
+                for v in vars:
+                    self.check(ctx[v], ("U",))
+            ty = self.infer(lbody)
+            if not checked:
+                self.check(instantiate(rhs, [("Var", v) for v in vars]), ty)
+        rules = self.rules.copy()  # Snapshots keep the old rules.
+        rules.hits = self.rules.hits
+        # Constants are turned into ("con", x) before anything else rewrites
+        # them, which the pattern ("Var", x) matches. Definitions would be
+        # unfolded instead, so they are no left hand sides.
+        head = "con" if lhs[-1][0] == "Var" else lhs[-1][0]
+        rules.add(head, name, pattern_rule(lhs, rhs))
+        self.rules = rules
+        self.user_rules += (name,)
+        self.version = next(self.versions)
+        return bind(vars, ty)
+
+    def execute(self, command, result=None):
+        """
+        Runs a top level statement and returns its result: the type of the
+        constant, definition or inferred term, or the normal form.
+        A result cached from an earlier run skips the checking.
+        """
+        match command:
+            case ("\\constant", name, ty):
+                self.declare(name, ty, checked=result is not None)
+                return ty
+            case ("\\define", name, body):
+                return self.define(name, body, result)
+            case ("\\rule", name, types, lhs, rhs):
+                return self.add_rule(name, types, lhs, rhs, checked=result is not None)
+            case ("\\infer", expr):
+                return result or self.infer(expr)
+            case ("\\normalize", expr):
+                return result or self.normalize(expr)
+
+    def delta(self, x, unfold=True):
+        """
+        What the free variable x unfolds to, or None.
+        Definitions are kept folded unless unfold is set.
+        """
+        if x not in self.context:
+            if (body := self.definitions.get(x)) is not None:
+                return body if unfold else None
+            elif x in self.constants:
+                return ("con", x)
+
+    def rewrite(self, expr, unfold=True):
+        return self.rules.rewrite(expr, self, unfold)
+
+    def _normalize(self, expr, unfold):  # Brutal CBV, expr is canonical.
         if not isinstance(expr, tuple):
             return None
-        changed = True
-        touched = False
+        nf = normal_form(expr, lambda t: self.rewrite(t, unfold))
+        return None if nf is expr else nf
+
+    def whnf(self, expr, unfold=True):
+        """
+        Reduce expr only until its head constructor is exposed.
+        The arguments are left unevaluated.
+        """
+        expr = hashcons(expr)
+        key = ("whnf", id(expr), unfold, self.version)
+        if (nf := self.cache.get(key)) is not None:
+            return nf
+        nf = expr
+        spine = []  # The applications and projections around nf, innermost last.
         while True:
-            while changed:
-                changed = False
-                rexpr = [expr[0]]
-                for subexpr in expr[1:]:
-                    rsubexpr = self._normalize(subexpr)
-                    if rsubexpr is not None:
-                        touched = True
-                        changed = True
-                        rexpr.append(rsubexpr)
-                    else:
-                        rexpr.append(subexpr)
-                expr = tuple(rexpr)
-            if re := self.rewrite(expr) is None:
-                return expr if touched else None
+            while nf[0] in ("@", "fst", "snd"):
+                spine.append(nf)
+                nf = nf[1]
+            if (re := self.rewrite(nf, unfold)) is not None:
+                nf = hashcons(re)
+                continue
+            while spine:  # Put the spine back until a redex appears.
+                elim = spine.pop()
+                nf = mk(elim[0], nf, *elim[2:])
+                if (re := self.rewrite(nf, unfold)) is not None:
+                    nf = hashcons(re)
+                    break
             else:
-                expr = re
+                break
+        self.cache[key] = nf
+        return nf
 
-    def normalize(self, expr):
-        return self._normalize(expr) or expr
+    def normalize(self, expr, unfold=False):
+        """
+        Normal form of expr. Definitions stay folded unless unfold is set,
+        in which case they are unfolded wherever they occur.
+        """
+        expr = hashcons(expr)
+        # Canonical terms are only freed by reset_tables, so their ids are
+        # stable keys until the cache is cleared with the tables.
+        key = ("nf", id(expr), unfold, self.version)
+        if (nf := self.cache.get(key)) is not None:
+            return nf
+        if self.engine == "nbe" and not self.user_rules:  # NbE has no user rules.
+            nf = NbE.normalize(expr, self.delta, unfold)
+        else:
+            nf = self._normalize(expr, unfold) or expr
+        self.cache[key] = nf
+        return nf
 
     def conversion(self, expr1, expr2, ty):
         if alpha(expr1, expr2):
             return
-        match ty := self.normalize(ty):
-            case ("Π", dom, ("Bind", x, cod)):
-                x = fresh(x)
-                self.conversion(("@", expr1, ("Var", x)), ("@", expr2, ("Var", x)), cod)
-            case ("Σ", dom, ("Bind", x, cod)):
+        match ty := self.whnf(ty):
+            case ("Π", dom, ("Bind", _, _) as cod):
+                (x,), cod = unbind(cod)
+                with self.push({x:dom}):
+                    self.conversion(("@", expr1, ("Var", x)), ("@", expr2, ("Var", x)), cod)
+            case ("Σ", dom, ("Bind", _, _) as cod):
                 self.conversion(("fst", expr1), ("fst", expr2), dom)
-                self.conversion(("snd", expr1), ("snd", expr2), subst(cod, {x:("fst", expr1)}))
+                self.conversion(("snd", expr1), ("snd", expr2), instantiate(cod, (("fst", expr1),)))
             case ("con", ("0" | "1")):
                 return
             case _: # TODO full eta is difficult.
-                if alpha(expr1:=self.normalize(expr1), expr2:=self.normalize(expr2)):
+                # Definitions are only unfolded if the folded forms differ.
+                if alpha(self.whnf(expr1, False), self.whnf(expr2, False)):
+                    return
+                expr1, expr2 = self.whnf(expr1), self.whnf(expr2)
+                match expr1, expr2:
+                    case _ if alpha(expr1, expr2):
+                        return
+                    case (("Π" | "Σ") as head, dom1, ("Bind", _, _) as cod1),\
+                        (head2, dom2, ("Bind", _, _) as cod2) if head == head2:
+                        self.conversion(dom1, dom2, ("U",))
+                        (x,), cod1 = unbind(cod1)
+                        with self.push({x:dom1}):
+                            self.conversion(cod1, instantiate(cod2, (("Var", x),)), ("U",))
+                        return
+                if self.neutral(expr1, expr2) is not None:
                     return
-                print(pretty(expr1), pretty(expr2))
-                if input("Are they equal? ") == "n":
-                    raise ValueError("Expected " + pretty(expr2) + ", got " + pretty(expr1))
+                if stuck(expr1) or stuck(expr2):
+                    # Id, ap, trR and fillR do not compute on everything yet.
+                    self.undecided(expr1, expr2, ty)
+                    return
+                raise ValueError("Expected " + pretty(expr2) + ", got " + pretty(expr1))
+
+    def neutral(self, expr1, expr2):
+        """
+        Compares the neutral terms expr1 and expr2, which are in weak head
+        normal form: first their heads, then their arguments pairwise at the
+        types given by the heads. Returns the type of expr1 if they are
+        convertible, None if their heads differ.
+        """
+        match expr1, expr2:
+            case ("Var", x), ("Var", y) if x == y:
+                return self.infer(expr1)
+            case (("U",) | ("con", _)), _ if expr1 is hashcons(expr2):
+                return self.infer(expr1)
+            case ("@", fun1, arg1), ("@", fun2, arg2):
+                if (ty := self.neutral(fun1, fun2)) is None:
+                    return None
+                (_, dom, cod) = self.ensure_head(ty, "Π")
+                self.conversion(arg1, arg2, dom)
+                return instantiate(cod, (arg1,))
+            case (("fst" | "snd") as head, pair1), (head2, pair2) if head == head2:
+                if (ty := self.neutral(pair1, pair2)) is None:
+                    return None
+                (_, dom, cod) = self.ensure_head(ty, "Σ")
+                return dom if head == "fst" else instantiate(cod, (("fst", pair1),))
+            case ((("Id" | "ap" | "trR" | "fillR") as head, ("Bind", *xs, _) as fam1,
+                ("Telescope", *left1),
+                ("Telescope", *right1),
+                ("Telescope", *eqs1), *ends1),
+                (head2, ("Bind", *ys, _) as fam2,
+                ("Telescope", *left2),
+                ("Telescope", *right2),
+                ("Telescope", *eqs2), *ends2)) \
+                if head == head2 and len(xs) == len(ys) == len(left2):
+                for tm1, tm2 in zip(left1 + right1 + eqs1, left2 + right2 + eqs2):
+                    self.conversion(tm1, tm2, self.infer(tm1))
+                vars, body1 = unbind(fam1)
+                body2 = instantiate(fam2, [("Var", v) for v in vars])
+                tys = self.infer_idScope(vars, left1, right1, eqs1)
+                with self.push({v:t for v, t in zip(vars, tys)}):
+                    self.conversion(body1, body2,
+                        self.infer(body1) if head == "ap" else ("U",))
+                if head != "ap":
+                    endtys = instantiate_many(fam1, (left1, right1)[:len(ends1)])
+                    for endty, tm1, tm2 in zip(endtys, ends1, ends2):
+                        self.conversion(tm1, tm2, endty)
+                return self.infer(expr1)
 
-    def infer(self, expr):
+    def undecided(self, expr1, expr2, ty):
+        """
+        Postpones a conversion problem that can neither be solved nor
+        refuted, or fails on it in strict mode.
+        """
+        problem = Undecided(expr1, expr2, ty, self.context)  # Persistent, no copy needed.
+        if self.strict:
+            raise problem
+        self.postponed.append(problem)
+
+    def infer(self, expr, snapshot=None):
+        """
+        The type of expr, in snapshot if it is given (see at), or else in the
+        current context.
+        """
+        if snapshot is not None:
+            return self.at(snapshot).infer(expr)
         match expr:
             case ("Var", x):
-                if x in self.context:
-                    return self.context[x]
-                elif x in self.definitions:
-                    return self.infer(self.definitions[x])
+                if (ty := self.context.get(x)) is not None:
+                    return ty
+                elif (ty := self.deftypes.get(x)) is not None:
+                    return ty
                 elif x in self.constants:
                     return self.constants[x]
                 raise ValueError("Unknown variable: " + x)
             case ("Bind", *_):
                 raise ValueError("Unexpected Bind: " + pretty(expr))
-            case (("Π" | "Σ"), dom, ("Bind", x, cod)):
+            case (("Π" | "Σ"), dom, ("Bind", _, _) as cod):
                 self.check(dom, ("U",))
+                (x,), cod = unbind(cod)
                 with self.push({x:dom}):
                     self.check(cod, ("U",))
                 return ("U",)
-            case ("λ", dom, ("Bind", x, body)):
+            case ("λ", dom, ("Bind", _, _) as body):
                 self.check(dom, ("U",))
+                (x,), body = unbind(body)
                 with self.push({x:dom}):
                     cod = self.infer(body)
-                return ("Π", dom, ("Bind", x, cod))
+                return ("Π", dom, bind((x,), cod))
             case ("@", fun, arg):
                 funty = self.infer(fun)
-                (_, dom, (_, x, cod)) = self.ensure_head(funty, "Π")
+                (_, dom, cod) = self.ensure_head(funty, "Π")
                 self.check(arg, dom)
-                return subst(cod, {x:arg})
-            case (",", ("Bind", x, tybody), tm1, tm2):
+                return instantiate(cod, (arg,))
+            case (",", ("Bind", _, _) as tyfam, tm1, tm2):
                 tyfst = self.infer(tm1)
+                (x,), tybody = unbind(tyfam)
                 with self.push({x:tyfst}):
                     self.check(tybody, ("U",))
-                self.check(tm2, subst(tybody, {x:tm1}))
-                return ("Σ", tyfst, ("Bind", x, tybody))
+                self.check(tm2, instantiate(tyfam, (tm1,)))
+                return ("Σ", tyfst, tyfam)
             case ("fst", pair):
                 pairty = self.infer(pair)
                 (_, dom, _) = self.ensure_head(pairty, "Σ")
                 return dom
             case ("snd", pair):
                 pairty = self.infer(pair)
-                (_, _, (_, x, cod)) = self.ensure_head(pairty, "Σ")
-                return subst(cod, {x:("fst", pair)})
+                (_, _, cod) = self.ensure_head(pairty, "Σ")
+                return instantiate(cod, (("fst", pair),))
             case ("con", con):  # constant
                 return self.constants[con]
             case ("U",):
                 return ("U",)  # Type in type.
-            case ("Id", ("Bind", *vars, ty),
+            case ("Id", ("Bind", *_) as tyfam,
                 ("Telescope", *left),
                 ("Telescope", *right),
                 ("Telescope", *eqs), lhs, rhs):
+                vars, ty = unbind(tyfam)
                 tys = self.infer_idScope(vars, left, right, eqs)
                 with self.push({v:t for v, t in zip(vars, tys)}):
                     self.check(ty, ("U",))
-                self.check(lhs, subst(ty, {v:l for v, l in zip(vars, left)}))
-                self.check(rhs, subst(ty, {v:r for v, r in zip(vars, right)}))
+                lty, rty = instantiate_many(tyfam, (left, right))
+                self.check(lhs, lty)
+                self.check(rhs, rty)
                 return ("U",)
-            case ("ap", ("Bind", *vars, expr),
+            case ("ap", ("Bind", *_) as fam,
                 ("Telescope", *left),
                 ("Telescope", *right),
                 ("Telescope", *eqs)):
+                vars, expr = unbind(fam)
                 tys = self.infer_idScope(vars, left, right, eqs)
                 with self.push({v:t for v, t in zip(vars, tys)}):
                     ty = self.infer(expr)
-                return ("Id", ("Bind", *vars, ty),
+                return ("Id", bind(vars, ty),
                     ("Telescope", *left),
                     ("Telescope", *right),
                     ("Telescope", *eqs),
-                    subst(ty, {v:l for v, l in zip(vars, left)}),
-                    subst(ty, {v:r for v, r in zip(vars, right)}))
-            case ("trR", ("Bind", *vars, ty),
+                    *instantiate_many(fam, (left, right)))
+            case ("trR", ("Bind", *_) as tyfam,
                 ("Telescope", *left),
                 ("Telescope", *right),
                 ("Telescope", *eqs), lhs):
+                vars, ty = unbind(tyfam)
                 tys = self.infer_idScope(vars, left, right, eqs)
                 with self.push({v:t for v, t in zip(vars, tys)}):
                     self.check(ty, ("U",))
-                self.check(lhs, subst(ty, {v:l for v, l in zip(vars, left)}))
-                return subst(ty, {v:r for v, r in zip(vars, right)})
-            case ("fillR", ("Bind", *vars, ty),
+                lty, rty = instantiate_many(tyfam, (left, right))
+                self.check(lhs, lty)
+                return rty
+            case ("fillR", ("Bind", *_) as tyfam,
                 ("Telescope", *left),
                 ("Telescope", *right),
                 ("Telescope", *eqs), lhs):
+                vars, ty = unbind(tyfam)
                 tys = self.infer_idScope(vars, left, right, eqs)
                 with self.push({v:t for v, t in zip(vars, tys)}):
                     self.check(ty, ("U",))
-                self.check(lhs, subst(ty, {v:l for v, l in zip(vars, left)}))
-                return ("Id", ("Bind", *vars, ty),
+                self.check(lhs, instantiate(tyfam, left))
+                return ("Id", tyfam,
                     ("Telescope", *left),
                     ("Telescope", *right),
                     ("Telescope", *eqs), lhs,
-                    ("trR", ("Bind", *vars, ty),
+                    ("trR", tyfam,
                         ("Telescope", *left),
                         ("Telescope", *right),
                         ("Telescope", *eqs), lhs))
@@ -209,44 +527,213 @@ class Checker:
             rty = self.infer(right[-1])
             self.conversion(lty, rty, ("U",))
             self.check(eqs[-1],
-                ("Id", ("Bind", *vars[:-1], lty),
+                ("Id", bind(vars[:-1], lty),
                     ("Telescope", *left[:-1]),
                     ("Telescope", *right[:-1]),
                     ("Telescope", *eqs[:-1]),
                     left[-1], right[-1]))
         return tys + (lty,)
 
-    def check(self, expr, ty):
+    def check(self, expr, ty, snapshot=None):
+        if snapshot is not None:
+            return self.at(snapshot).check(expr, ty)
         ty1 = self.infer(expr)
         self.conversion(ty1, ty, ("U",))
 
     def ensure_head(self, expr, head):
         """
-        Ensures that the normal form of expr has head head.
+        Ensures that the weak head normal form of expr has head head.
         """
-        # Directly normalizing, slow.
-        expr = self.normalize(expr)
+        expr = self.whnf(expr)
         if expr[0] != head:
             raise ValueError("Expected " + head + ", got " + pretty(expr))
         return expr
 
+def check_statements(checker, statements, cache=None):
+    """
+    Runs the statements in order, yielding each with its result.
+    With a StatementCache, a statement is only checked again if it or one
+    of the statements it depends on has changed.
+    """
+    keys = {}  # The cache key of the statement introducing each name.
+    rules = []  # The cache keys of the rules, which every later statement may use.
+    for command in statements:
+        if cache is None:
+            yield command, checker.execute(command)
+            continue
+        key = cache.key(command, [keys[x] for x in freevar(command) if x in keys] + rules)
+        postponed = len(checker.postponed)
+        result = checker.execute(command, cache.get(key))
+        if len(checker.postponed) == postponed:  # Undecided results are not kept.
+            cache[key] = result
+        if command[0] in ("\\constant", "\\define"):
+            keys[command[1]] = key
+        elif command[0] == "\\rule":
+            rules.append(key)
+        yield command, result
+
+worker_base = None  # The checker state a worker process starts each job from.
+
+def init_worker(constants, definitions, deftypes, engine, strict):
+    global worker_base
+    worker_base = (constants, definitions, deftypes, engine, strict)
+
+def run_worker(deps, command):
+    """
+    Runs command in a worker, after replaying the statements it depends on
+    with their known results. Returns the result and the conversion problems
+    postponed while checking command.
+    """
+    constants, definitions, deftypes, engine, strict = worker_base
+    checker = Checker(constants, engine, strict=strict)
+    checker.definitions, checker.deftypes = definitions, deftypes
+    for dep, result in deps:
+        checker.execute(dep, result)
+    return checker.execute(command), checker.postponed
+
+def check_parallel(checker, statements, workers=None, cache=None):
+    """
+    Like check_statements, but statements that do not depend on each other
+    are checked in parallel on a pool of workers processes (by default one
+    per CPU). The results are yielded in the original order, and replayed
+    into checker.
+    """
+    statements = list(statements)
+    introduced = {}  # The index of the statement introducing each name.
+    keys = []
+    deps = []  # The indices of all the statements each one depends on.
+    dependents = [[] for _ in statements]
+    waiting = []  # The number of direct dependencies not yet done.
+    results = {}
+    postponed = {}
+    rules = set()  # Every later statement depends on the rules.
+    for i, command in enumerate(statements):
+        direct = {introduced[x] for x in freevar(command) if x in introduced} | rules
+        deps.append(set().union(direct, *(deps[j] for j in direct)))
+        for j in direct:
+            dependents[j].append(i)
+        waiting.append(len(direct))
+        if cache is not None:
+            keys.append(cache.key(command, (keys[j] for j in direct)))
+            # Jobs replay the results of all their dependencies, so a result
+            # is only reused if those of its dependencies are.
+            if not direct <= results.keys():
+                cache.checked += 1
+            elif (result := cache.get(keys[i])) is not None:
+                results[i] = result
+        if command[0] in ("\\constant", "\\define"):
+            introduced[command[1]] = i
+        elif command[0] == "\\rule":
+            rules.add(i)
+    with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(
+        checker.constants, checker.definitions, checker.deftypes, checker.engine,
+        checker.strict)) as pool:
+        running = {}
+        def done(i):
+            for k in dependents[i]:
+                waiting[k] -= 1
+                if waiting[k] == 0 and k not in results:
+                    submit(k)
+        def submit(i):
+            jobs = [(statements[j], results[j]) for j in sorted(deps[i])]
+            running[pool.submit(run_worker, jobs, statements[i])] = i
+        for i in range(len(statements)):
+            if waiting[i] == 0 and i not in results:
+                submit(i)
+        for i in list(results):
+            done(i)
+        for i, command in enumerate(statements):
+            while i not in results:
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    j = running.pop(future)
+                    if (error := future.exception()) is not None:
+                        results[j] = error
+                    else:
+                        results[j], postponed[j] = future.result()
+                        done(j)
+            if isinstance(results[i], Exception):
+                raise results[i]
+            checker.postponed.extend(postponed.get(i, ()))
+            if cache is not None and not postponed.get(i):
+                cache[keys[i]] = results[i]
+            yield command, checker.execute(command, results[i])
+
 if __name__ == "__main__":
-    with open("test.hott", "r") as f:
-        code = f.read()
-    checker = Checker(constants={
-        "0" : ("U",),
-        "1" : ("U",),
-        "*" : ("con", "1"),
-        "absurd" : ("Π", ("0",), ("Bind", "_", ("Π", ("U",), ("Bind", "T", ("Var", "T")))))
-    })
-    for command in file_parse(code):
+    import argparse, sys
+    from Cache import StatementCache
+    argparser = argparse.ArgumentParser(description="Checks a .hott file.")
+    argparser.add_argument("file", nargs="?", default="test.hott")
+    argparser.add_argument("--cache", metavar="PATH",
+        help="reuse the results of unchanged statements stored at PATH")
+    argparser.add_argument("--jobs", "-j", metavar="N", type=int, nargs="?", const=0,
+        help="check independent statements in parallel on N processes "
+            "(all CPUs if N is omitted)")
+    argparser.add_argument("--instrument", choices=("table", "json"),
+        help="count and time the hot paths of each statement, and print them "
+            "on stderr in the given format")
+    argparser.add_argument("--rule-stats", action="store_true",
+        help="print how often each rewrite rule fired")
+    argparser.add_argument("--strict", action="store_true",
+        help="fail on conversion problems that cannot be decided, "
+            "instead of postponing them")
+    argparser.add_argument("--width", metavar="N", type=int,
+        help="break the printed terms into lines of N characters where possible")
+    argparser.add_argument("--max-nodes", metavar="N", type=int,
+        help="only print the first N nodes of each term")
+    argparser.add_argument("--max-depth", metavar="N", type=int,
+        help="only print each term down to depth N")
+    argparser.add_argument("--share", action="store_true",
+        help="print repeated subterms once, as lets")
+    args = argparser.parse_args()
+    style = {"width" : args.width, "nodes" : args.max_nodes, "depth" : args.max_depth,
+        "share" : args.share}
+    if args.instrument and args.jobs is not None:
+        argparser.error("--instrument does not see into worker processes")
+    source = open(args.file, "rb")
+    checker = Checker(constants=dict(BUILTINS), strict=args.strict)
+    cache = None
+    if args.cache:
+        cache = StatementCache(args.cache, repr(sorted(checker.constants.items())))
+    if args.jobs is None:
+        statements = check_statements(checker, file_parse(source), cache)
+    else:
+        statements = check_parallel(checker, file_parse(source), args.jobs or None, cache)
+    if args.instrument:
+        import Instrument
+        instrument = Instrument.Instrument()
+        instrument.enable(Checker)
+        rows = []
+        snapshot = instrument.snapshot()
+    for command, result in statements:
+        if args.instrument:
+            rows.append((" ".join((command[0], *command[1:2]))
+                if command[0] not in ("\\infer", "\\normalize")
+                else command[0] + " " + pretty(command[1]), instrument.since(snapshot)))
+            snapshot = instrument.snapshot()
         match command:
-            case ("\\constant", name, ty):
-                checker.constants[name] = ty
-            case ("\\define", name, body):
-                checker.definitions[name] = body
             case ("\\infer", expr):
-                print(pretty(expr), " is of type:")
-                print(pretty(checker.infer(expr)))
+                pretty(expr, sys.stdout, **style)
+                print("  is of type:")
+                pretty(result, sys.stdout, **style)
+                print()
             case ("\\normalize", expr):
-                print(pretty(checker.normalize(expr)))
+                pretty(result, sys.stdout, **style)
+                print()
+    source.close()
+    for problem in checker.postponed:
+        print("Postponed:", problem, file=sys.stderr)
+    if args.instrument == "table":
+        print(Instrument.table(rows), file=sys.stderr)
+    elif args.instrument == "json":
+        import json
+        json.dump([{"statement" : s, "counters" : c} for s, c in rows], sys.stderr,
+            indent=1, ensure_ascii=False)
+        print(file=sys.stderr)
+    if args.rule_stats:
+        for name, hits in checker.rules.hits.most_common():
+            print("%s: %d" % (name, hits), file=sys.stderr)
+    if cache is not None:
+        cache.save()
+        print("Reused %d of %d statements." % (cache.reused, cache.reused + cache.checked),
+            file=sys.stderr)
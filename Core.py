@@ -1,10 +1,94 @@
+from bisect import bisect_left
 """
-Core Syntax: Use Lisp style tuples.
+Core Syntax: Use Lisp style tuples, locally nameless.
 
-("Var", x) : Variables.
-("Bind", *xs, t) : Bind variables.
+("Var", x) : Free variables.
+("Idx", i) : Bound variables, as de Bruijn indices.
+("Bind", *xs, t) : Bind variables. The names xs are only hints for printing,
+    inside t the last of xs is ("Idx", 0) and the first is ("Idx", len(xs)-1).
+
+Named terms (where ("Var", x) may also refer to a binder) only exist at the
+parser and pretty-printer boundary, see to_nameless and from_nameless. So do
+("let", value, ("Bind", x, body)), which to_nameless substitutes away.
+Binders are opened with fresh free variables by unbind, and closed by bind.
+
+Terms built through mk (or passed through hashcons) are hash-consed: there is
+exactly one canonical tuple per distinct node, so canonical terms can be
+compared with `is` and keyed by `id`. The free variables and loose indices of
+canonical nodes are computed once and cached, see freevar and loose. The
+tables are only emptied by reset_tables.
+Substitutions return untouched subterms as they are, without copying them.
 """
 fresh = 0  # Global counter for fresh variables.
+interned = {}  # Canonical nodes, keyed by their tag/leaves and child ids.
+canonical = set()  # ids of canonical nodes, which are kept alive by interned.
+freevars = {}  # Free variables of canonical nodes, keyed by id.
+loosebounds = {}  # See loose, keyed by id.
+
+def mk(*node):
+    """
+    Build the canonical node with the given tag and children.
+    The children are assumed to be canonical already.
+    """
+    # Children are compared by identity, leaves (tags, names) by value.
+    key = tuple(id(c) if type(c) is tuple else c for c in node)
+    if (t := interned.get(key)) is None:
+        t = interned[key] = node
+        canonical.add(id(t))
+    return t
+
+def hashcons(t):
+    """
+    Return the canonical copy of t.
+    """
+    if type(t) is not tuple or id(t) in canonical:
+        return t
+    return _traverse(t, lambda t, _, ts: mk(t[0], *ts),
+        lambda t, _: t if id(t) in canonical else None)
+
+def reset_tables():
+    """
+    Empty the hash-consing tables, to bound the memory of long running
+    processes. Terms built before stay valid but are no longer canonical, so
+    caches keyed by their ids (such as the normal forms of a Checker) must
+    be emptied too.
+    """
+    for table in (interned, canonical, freevars, loosebounds):
+        table.clear()
+
+def _traverse(term, node, skip=None, depth=0, scoped=False, cache=None):
+    # Compute node(t, depth, results) bottom up for the subterms t of term,
+    # with an explicit stack instead of recursion. results has the result of
+    # each tuple child of t and the other children as they are. skip(t, depth)
+    # may give the result of t without visiting it. Results are shared per
+    # subterm, or per subterm and depth if scoped (depth grows under Binds).
+    # cache keeps the results of canonical subterms across calls.
+    done = {}
+    stack = [(term, depth)]
+    while stack:
+        t, d = stack[-1]
+        k = (id(t), d) if scoped else id(t)
+        if k in done:
+            stack.pop()
+            continue
+        if cache is not None and (r := cache.get(id(t))) is not None \
+            or skip is not None and (r := skip(t, d)) is not None:
+            done[k] = r
+            stack.pop()
+            continue
+        cd = d + len(t) - 2 if t[0] == "Bind" else d
+        n = len(stack)
+        for c in reversed(t):
+            if type(c) is tuple and ((id(c), cd) if scoped else id(c)) not in done:
+                stack.append((c, cd))
+        if len(stack) > n:
+            continue
+        stack.pop()
+        done[k] = r = node(t, d, [done[(id(c), cd) if scoped else id(c)]
+            if type(c) is tuple else c for c in t[1:]])
+        if cache is not None and id(t) in canonical:
+            cache[id(t)] = r
+    return done[(id(term), depth) if scoped else id(term)]
 
 def fresh_var(name="x"):
     global fresh
@@ -13,22 +97,278 @@ def fresh_var(name="x"):
 
 def subst(t, subs : dict):
     """
-    Substitute variables in t with values in subs.
-    """
-    match t:
-        case ("Var", y) if y in subs:
-            return subs[y]
-        case ("Var", _):
-            return t
-        case ("Bind", *xs, body):
-            ys = [fresh_var(x) for x in xs]
-            new_subs = {x:subs[x] for x in subs}
-            new_subs.update({y:("Var", ys[i]) for i, y in enumerate(xs)})
-            return ("Bind", *ys, subst(body, new_subs))
-        case (cons, *ts):
-            return (cons, *(subst(t, subs) for t in ts))
-        case _:
-            return t
+    Substitute free variables in t with values in subs.
+    No renaming is needed, bound variables cannot be captured.
+    Subterms without any of the variables of subs are returned as they are.
+    """
+    t = hashcons(t)
+    if type(t) is not tuple:
+        return t
+    def node(t, _, ts):
+        if t[0] == "Var":
+            return hashcons(subs[t[1]])
+        return _rebuild(t, ts)
+    return _traverse(t, node, lambda t, _: t if freevar(t).isdisjoint(subs) else None)
+
+def _rebuild(t, ts):
+    # The canonical t with its children replaced by ts, t itself if they are.
+    if all(a is b for a, b in zip(t[1:], ts)):
+        return t
+    return mk(t[0], *ts)
+
+def _unchanged(t, depth):
+    # Substitutions for the indices from depth on leave t as it is.
+    return t if loose(t) <= depth else None
+
+def _shift(t, n, depth=0):
+    # Shift the indices in t that escape depth binders up by n.
+    if type(t) is not tuple:
+        return t
+    def node(t, _, ts):
+        if t[0] == "Idx":
+            return mk("Idx", t[1] + n)
+        return _rebuild(t, ts)
+    return _traverse(t, node, _unchanged, depth, scoped=True)
+
+def _instantiate(t, args, depth):
+    # args[k] replaces ("Idx", depth + k), outer indices are shifted down.
+    # args need not be locally closed, e.g. when normalizing under binders.
+    if type(t) is not tuple:
+        return t
+    def node(t, d, ts):
+        if t[0] == "Idx":
+            if (i := t[1]) - d < len(args):
+                return _shift(args[i - d], d) if d else args[i - d]
+            return mk("Idx", i - len(args))
+        return _rebuild(t, ts)
+    return _traverse(t, node, _unchanged, depth, scoped=True)
+
+def instantiate(b, args):
+    """
+    Substitute args for the variables bound by b = ("Bind", *xs, body).
+    """
+    return _instantiate(hashcons(b[-1]), tuple(hashcons(a) for a in reversed(args)), 0)
+
+def instantiate_many(b, argss):
+    """
+    Instantiate b = ("Bind", *xs, body) at each of the lists of arguments
+    argss, e.g. the left and right endpoints of a telescope, in a single
+    traversal. The instances share every subterm where they do not differ.
+    """
+    argss = [tuple(hashcons(a) for a in reversed(args)) for args in argss]
+    def node(t, d, ts):
+        if t[0] == "Idx":
+            return tuple(_instantiate(t, args, d) for args in argss)
+        return tuple(_rebuild(t, list(row)) for row in
+            zip(*(c if type(c) is tuple else (c,) * len(argss) for c in ts)))
+    return _traverse(hashcons(b[-1]), node,
+        lambda t, d: (t,) * len(argss) if loose(t) <= d else None, scoped=True)
+
+def _abstract(t, xs, depth):
+    # Indices escaping t are shifted up to make room for xs.
+    if type(t) is not tuple:
+        return t
+    def node(t, d, ts):
+        match t:
+            case ("Var", x):
+                return mk("Idx", d + xs.index(x))
+            case ("Idx", i):
+                return mk("Idx", i + len(xs))
+        return _rebuild(t, ts)
+    return _traverse(t, node,
+        lambda t, d: t if loose(t) <= d and freevar(t).isdisjoint(xs) else None,
+        depth, scoped=True)
+
+def bind(xs, t):
+    """
+    Bind the free variables xs in t. Inverse of unbind.
+    """
+    return mk("Bind", *(x.split("#")[0] for x in xs),
+        _abstract(hashcons(t), tuple(reversed(xs)), 0))
+
+def unbind(b):
+    """
+    Open b = ("Bind", *xs, body) with fresh variables.
+    Returns the fresh names and the opened body.
+    """
+    ys = tuple(fresh_var(x) for x in b[1:-1])
+    return ys, instantiate(b, [mk("Var", y) for y in ys])
+
+def occurs(t, i):
+    """
+    Return True if the bound variable ("Idx", i) occurs in t.
+    """
+    stack = [(t, i)]
+    while stack:
+        t, i = stack.pop()
+        if id(t) in canonical and loose(t) <= i:
+            continue
+        match t:
+            case ("Idx", j):
+                if i == j:
+                    return True
+            case ("Bind", *xs, body):
+                stack.append((body, i + len(xs)))
+            case (_, *ts):
+                stack.extend((t, i) for t in ts if isinstance(t, tuple))
+    return False
+
+VISIT, BUILD, LEAVE = "visit", "build", "leave"  # Steps of the iterative traversals.
+
+def to_nameless(t, scope=()):
+    """
+    Convert a named term into the locally nameless syntax.
+    scope lists the names bound around t, innermost last.
+    """
+    levels = {}  # The levels each name is bound at, innermost last.
+    for k, x in enumerate(scope):
+        levels.setdefault(x, []).append(k)
+    depth = len(scope)
+    out = []  # The converted subterms, which their parents are built from.
+    work = [(VISIT, t)]
+    while work:
+        op, t = work.pop()
+        if op is VISIT:
+            match t:
+                case ("Var", x) if levels.get(x):
+                    out.append(mk("Idx", depth - 1 - levels[x][-1]))
+                case ("Bind", *xs, body):
+                    for x in xs:
+                        levels.setdefault(x, []).append(depth)
+                        depth += 1
+                    work.append((LEAVE, t))
+                    work.append((VISIT, body))
+                case (_, *ts):
+                    work.append((BUILD, t))
+                    work.extend((VISIT, c) for c in reversed(ts))
+                case _:
+                    out.append(t)
+        elif op is BUILD:
+            n = len(t) - 1
+            if t[0] == "let":
+                node = instantiate(out[-1], [out[-2]])
+            else:
+                node = mk(t[0], *out[len(out) - n:])
+            del out[len(out) - n:]
+            out.append(node)
+        else:
+            xs = t[1:-1]
+            for x in xs:
+                levels[x].pop()
+            depth -= len(xs)
+            out.append(mk("Bind", *xs, out.pop()))
+    return out[0]
+
+def _references(t):
+    # The walk of _named numbers the nodes of t it visits in order, and the
+    # Binds it enters. Returns when each binder, keyed by Bind number and
+    # position, and each free variable, keyed by name, is referred to, and
+    # the numbers of the nodes under each Bind. Found in one pass rather
+    # than an occurs per binder.
+    refs = {}
+    spans = []
+    levels = []  # The Bind number and position of the enclosing binders.
+    time = 0
+    work = [(VISIT, t)]
+    while work:
+        op, t = work.pop()
+        if op is VISIT:
+            time += 1
+            match t:
+                case ("Idx", i):
+                    if i < len(levels):
+                        refs.setdefault(levels[-1-i], []).append(time)
+                case ("Var", x):
+                    refs.setdefault(x, []).append(time)
+                case ("Bind", *xs, body):
+                    b = len(spans)
+                    spans.append([time, time])
+                    levels.extend((b, k) for k in range(len(xs)))
+                    work.append((LEAVE, (b, len(xs))))
+                    work.append((VISIT, body))
+                case (_, *ts):
+                    work.extend((VISIT, c) for c in reversed(ts) if type(c) is tuple)
+        else:
+            b, n = t
+            spans[b][1] = time
+            del levels[len(levels) - n:]
+    return refs, spans
+
+def _referred(times, span):
+    # Whether any of the sorted times is in span.
+    k = bisect_left(times, span[0])
+    return k < len(times) and times[k] <= span[1]
+
+def _named(t, taken):
+    # taken counts the names of the enclosing binders and the free variables,
+    # which renamed binders do not reuse. A binder keeps its hint unless that
+    # would capture a variable its body refers to (or it is a "_" that is
+    # referred to). Renamed binders are numbered per call rather than by
+    # fresh_var, and in names the lexer reads back, so that a term prints
+    # the same however many fresh variables were made before.
+    refs, spans = _references(t)
+    names = []  # The names of the enclosing binders, innermost last.
+    binders = {}  # The Bind number and position of the binders by name.
+    suffixes = {}  # The last number given to each name.
+    bound = 0
+    out = []
+    work = [(VISIT, t)]
+    while work:
+        op, t = work.pop()
+        if op is VISIT:
+            match t:
+                case ("Idx", i):
+                    out.append(("Var", names[-1-i]))
+                case ("Var", _):
+                    out.append(t)
+                case ("Bind", *xs, body):
+                    b, bound = bound, bound + 1
+                    ys = []
+                    for k, x in enumerate(xs):
+                        x = x.split("#")[0]  # Hints may come from fresh_var.
+                        if x == "_" and not refs.get((b, k)):
+                            ys.append(x)
+                            continue
+                        if x == "_" or _referred(refs.get(binders[x][-1] if binders.get(x)
+                                else x, ()), spans[b]):
+                            n = suffixes.get(x, 0) + 1
+                            while x + str(n) in taken:
+                                n += 1
+                            suffixes[x] = n
+                            x += str(n)
+                        ys.append(x)
+                        binders.setdefault(x, []).append((b, k))
+                        taken[x] = taken.get(x, 0) + 1
+                    names.extend(ys)
+                    work.append((LEAVE, ys))
+                    work.append((VISIT, body))
+                case (_, *ts):
+                    work.append((BUILD, t))
+                    work.extend((VISIT, c) for c in reversed(ts))
+                case _:
+                    out.append(t)
+        elif op is BUILD:
+            n = len(t) - 1
+            node = (t[0], *out[len(out) - n:])
+            del out[len(out) - n:]
+            out.append(node)
+        else:
+            del names[len(names) - len(t):]
+            for y in t:
+                if y != "_":  # Unused "_" binders were not taken.
+                    binders[y].pop()
+                    taken[y] -= 1
+                    if taken[y] == 0:
+                        del taken[y]
+            out.append(("Bind", *t, out.pop()))
+    return out[0]
+
+def from_nameless(t):
+    """
+    Convert a locally nameless term back into a named term, renaming binders
+    whose hints would capture a variable.
+    """
+    return _named(t, dict.fromkeys(freevar(t), 1))
 
 def strip_parens(str):
     if str[0] == "(" and str[-1] == ")":
@@ -44,28 +384,64 @@ def pretty_Var(v):
 
 def freevar(term):
     """
-    Return a set of free variables in term.
+    Return the frozenset of free variables in term.
+    Canonical terms only compute it once.
+    """
+    def node(t, _, fvs):
+        match t:
+            case ("Var", x):
+                return frozenset((x,))
+            case ("Idx", _):
+                return frozenset()
+        fv = frozenset()
+        for fvt in fvs:
+            if type(fvt) is frozenset and fvt and fvt is not fv:
+                fv = fvt if not fv else fv | fvt
+        return fv
+    if type(term) is not tuple:
+        raise ValueError("Unexpected term: " + str(term))
+    return _traverse(term, node, cache=freevars)
+
+def loose(term):
+    """
+    Return the number of binders term must be under to be locally closed,
+    that is one more than its largest loose index, or 0.
+    """
+    def node(t, _, ns):
+        match t:
+            case ("Idx", i):
+                return i + 1
+            case ("Bind", *xs, _):
+                return max(ns[-1] - len(xs), 0)
+        return max((n for n, c in zip(ns, t[1:]) if type(c) is tuple), default=0)
+    return _traverse(term, node, cache=loosebounds)
+
+def closed(term):
+    """
+    Return True if term has no free variables.
     """
-    match term:
-        case ("Var", x):
-            return {x}
-        case ("Bind", *xs, t):
-            return freevar(t) - set(xs)
-        case (cons, *ts):
-            return set.union(*(freevar(t) for t in ts))
-        case _:
-            raise ValueError("Unexpected term: " + str(term))
+    return not freevar(term)
 
 def alpha(t1, t2) -> bool:
     """
     Return True if t1 and t2 are alpha equivalent.
+    Binder names are only hints, so this is a structural comparison.
     """
-    match t1, t2:
-        case ("Var", x), ("Var", y):
-            return x == y
-        case ("Bind", *xs, t1), ("Bind", *ys, t2):
-            return alpha(t1, subst(t2, {y:("Var", x) for x, y in zip(xs, ys)}))
-        case (cons1, *ts1), (cons2, *ts2) if cons1 == cons2:
-            return all(alpha(t1, t2) for t1, t2 in zip(ts1, ts2))
-        case _:
-            return t1 == t2
+    stack = [(hashcons(t1), hashcons(t2))]
+    while stack:
+        t1, t2 = stack.pop()
+        if t1 is t2:
+            continue
+        match t1, t2:
+            case ("Bind", *xs, t1), ("Bind", *ys, t2):
+                if len(xs) != len(ys):
+                    return False
+                stack.append((t1, t2))
+            case (cons1, *ts1), (cons2, *ts2) if cons1 == cons2:
+                if len(ts1) != len(ts2):
+                    return False
+                stack.extend(zip(ts1, ts2))
+            case _:
+                if t1 != t2:
+                    return False
+    return True
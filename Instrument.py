@@ -0,0 +1,108 @@
+import Core
+import Rules
+from collections import Counter
+import sys
+import time
+"""
+Opt-in instrumentation of the hot paths.
+
+While enabled, calls to Core.subst, Core.alpha, Core.fresh_var,
+Checker.conversion and Checker.infer, and tries of each rewrite rule
+("rule:<name>"), are counted and timed. Nothing is wrapped while it is
+disabled, so it costs nothing then.
+
+Times are inclusive, and only the outermost of nested calls of the same
+function is timed, so that recursion is not counted twice. The time of a
+rule includes the rewriting it triggers itself.
+"""
+
+FUNCTIONS = ("subst", "alpha", "fresh_var")
+METHODS = ("conversion", "infer")
+
+class Instrument:
+    def __init__(self):
+        self.calls = Counter()
+        self.times = Counter()
+        self.active = Counter()  # The nesting of the calls being timed.
+        self.patched = []  # (owner, name, original)
+
+    def wrap(self, name, fun):
+        calls, times, active = self.calls, self.times, self.active
+        def wrapper(*args, **kwargs):
+            calls[name] += 1
+            if active[name]:
+                return fun(*args, **kwargs)
+            active[name] += 1
+            start = time.perf_counter()
+            try:
+                return fun(*args, **kwargs)
+            finally:
+                times[name] += time.perf_counter() - start
+                active[name] -= 1
+        return wrapper
+
+    def patch(self, owner, name, new):
+        self.patched.append((owner, name, getattr(owner, name)))
+        setattr(owner, name, new)
+
+    def enable(self, checker=None):
+        """
+        Wrap the instrumented functions, wherever they have been imported,
+        and the methods of the checker class (Checker.Checker by default).
+        """
+        if checker is None:
+            from Checker import Checker as checker
+        if self.patched:
+            return
+        for name in FUNCTIONS:
+            original = getattr(Core, name)
+            wrapper = self.wrap(name, original)
+            for module in list(sys.modules.values()):
+                if getattr(module, "__dict__", {}).get(name) is original:
+                    self.patch(module, name, wrapper)
+        for name in METHODS:
+            self.patch(checker, name, self.wrap(name, getattr(checker, name)))
+        self.patch(Rules.Rules, "rewrite", self.rewrite())
+
+    def disable(self):
+        while self.patched:
+            owner, name, original = self.patched.pop()
+            setattr(owner, name, original)
+
+    def rewrite(self):
+        # Rules.rewrite, timing each rule tried.
+        calls, times = self.calls, self.times
+        def rewrite(rules, expr, *args):
+            for name, rule in rules.heads.get(expr[0], ()):
+                key = "rule:" + name
+                calls[key] += 1
+                start = time.perf_counter()
+                re = rule(expr, *args)
+                times[key] += time.perf_counter() - start
+                if re is not None:
+                    rules.hits[name] += 1
+                    return re
+        return rewrite
+
+    def snapshot(self):
+        return Counter(self.calls), Counter(self.times)
+
+    def since(self, snapshot):
+        """
+        The calls and time of each counter since snapshot was taken.
+        """
+        calls, times = snapshot
+        return {name : {"calls" : self.calls[name] - calls[name],
+            "time" : self.times[name] - times[name]}
+            for name in sorted(self.calls) if self.calls[name] != calls[name]}
+
+def table(rows):
+    """
+    Format rows of (statement, counters), as given by Instrument.since.
+    """
+    lines = []
+    for statement, counters in rows:
+        lines.append("%-40s %10s %12s" % (statement[:40], "calls", "time (ms)"))
+        for name, c in sorted(counters.items(), key=lambda item: -item[1]["time"]):
+            lines.append("  %-38s %10d %12.3f" % (name, c["calls"], c["time"] * 1000))
+    return "\n".join(lines)
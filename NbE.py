@@ -0,0 +1,198 @@
+from Core import *
+"""
+Normalization by evaluation.
+
+Terms are evaluated into values, which are again Lisp style tuples:
+
+("U",), ("con", c)           : Constants.
+("Π" | "Σ" | "λ", dom, clo)  : Binders, the body is a closure.
+(",", clo, fst, snd)         : Pairs, clo is the type family of snd.
+("Closure", env, b, delta)   : The Bind b waiting for its variables.
+                               Environments are linked lists (v, env).
+Arguments are evaluated call-by-need: they are passed as thunks, which are
+only evaluated when the variable they are bound to is first used, and then
+shared by all the uses. Environments and arguments of neutral applications
+may hold thunks, see value.
+Neutral values:
+("Var", x)                   : Free variables.
+("Lvl", k)                   : Variables bound during readback, de Bruijn levels.
+("@", neu, v), ("fst", neu), ("snd", neu)
+(("Id" | "ap" | "trR" | "fillR"), clo, left, right, eqs, *ends)
+                             : Stuck higher dimensional forms.
+Glued values:
+("Glued", neu, thunk)        : A spine headed by a defined name, together with
+                               its unfolding, which is only computed on demand.
+
+Readback turns values into normal forms, with levels turned back into indices.
+It either keeps definitions folded or reads back their unfoldings. A value
+shared by several places is only read back once, so the normal form shares
+it as well.
+"""
+
+def thunk(compute):
+    return [None, compute]
+
+def force(th):
+    if th[1] is not None:
+        th[0], th[1] = th[1](), None
+    return th[0]
+
+def value(v):
+    # Values are tuples, thunks are lists.
+    return force(v) if type(v) is list else v
+
+def delay(t, env, delta):
+    """
+    The value of t in env, as a thunk unless it is cheap to compute.
+    """
+    match t:
+        case ("Idx", i):
+            return lookup(env, i)  # Shares the thunk of the variable.
+        case ("Var", _) | ("U",) | ("con", _):
+            return evaluate(t, env, delta)
+    return thunk(lambda: evaluate(t, env, delta))
+
+def lookup(env, i):
+    while i:
+        env = env[1]
+        i -= 1
+    return env[0]
+
+def extend(env, args):
+    for a in args:
+        env = (a, env)
+    return env
+
+def inst(clo, args):
+    """
+    Apply the closure to the values args, one for each bound variable.
+    """
+    (_, env, b, delta) = clo
+    return evaluate(b[-1], extend(env, args), delta)
+
+def closure(env, b, delta):
+    return ("Closure", env, b, delta)
+
+def vapp(fun, arg):
+    match fun:
+        case ("λ", _, clo):
+            return inst(clo, (arg,))
+        case ("Glued", neu, th):
+            return ("Glued", ("@", neu, arg), thunk(lambda: vapp(force(th), arg)))
+        case _:
+            return ("@", fun, arg)
+
+def vfst(pair):
+    match pair:
+        case (",", _, fst, _):
+            return fst
+        case ("Glued", neu, th):
+            return ("Glued", ("fst", neu), thunk(lambda: vfst(force(th))))
+        case _:
+            return ("fst", pair)
+
+def vsnd(pair):
+    match pair:
+        case (",", _, _, snd):
+            return snd
+        case ("Glued", neu, th):
+            return ("Glued", ("snd", neu), thunk(lambda: vsnd(force(th))))
+        case _:
+            return ("snd", pair)
+
+def evaluate(t, env, delta):
+    """
+    Evaluate t in env. delta(x) gives the term a free variable x unfolds to,
+    or None if x is neutral.
+    """
+    match t:
+        case ("Idx", i):
+            return value(lookup(env, i))
+        case ("Var", x):
+            if delta is not None and (d := delta(x)) is not None:
+                if d[0] == "con":  # Constants are their own unfolding.
+                    return d
+                return ("Glued", t, thunk(lambda: evaluate(d, None, delta)))
+            return t
+        case (("Π" | "Σ" | "λ") as head, dom, b):
+            return (head, evaluate(dom, env, delta), closure(env, b, delta))
+        case ("@", fun, arg):
+            return vapp(evaluate(fun, env, delta), delay(arg, env, delta))
+        case (",", b, fst, snd):
+            return (",", closure(env, b, delta),
+                evaluate(fst, env, delta), evaluate(snd, env, delta))
+        case ("fst", pair):
+            return vfst(evaluate(pair, env, delta))
+        case ("snd", pair):
+            return vsnd(evaluate(pair, env, delta))
+        case (("Id" | "ap" | "trR" | "fillR") as head, b,
+            ("Telescope", *left),
+            ("Telescope", *right),
+            ("Telescope", *eqs), *ends):
+            return (head, closure(env, b, delta),
+                tuple(evaluate(l, env, delta) for l in left),
+                tuple(evaluate(r, env, delta) for r in right),
+                tuple(evaluate(e, env, delta) for e in eqs),
+                *(evaluate(e, env, delta) for e in ends))
+        case _:  # U and constants
+            return t
+
+def readback_closure(clo, lvl, unfold, memo=None):
+    if memo is not None and (r := memo.get((id(clo), lvl))) is not None:
+        return r[1]
+    (_, _, b, _) = clo
+    n = len(b) - 2
+    body = inst(clo, [("Lvl", lvl + k) for k in range(n)])
+    r = mk("Bind", *b[1:-1], readback(body, lvl + n, unfold, memo))
+    if memo is not None:
+        memo[(id(clo), lvl)] = (clo, r)
+    return r
+
+def readback(v, lvl, unfold=False, memo=None):
+    """
+    Read back the value v under lvl bound variables into a normal form.
+    Definitions are read back folded unless unfold is set. memo keeps what
+    has been read back, by value and level.
+    """
+    v = value(v)
+    if memo is not None and (r := memo.get((id(v), lvl))) is not None:
+        return r[1]
+    match v:
+        case ("Lvl", k):
+            return mk("Idx", lvl - 1 - k)
+        case ("Glued", neu, th):
+            r = readback(force(th) if unfold else neu, lvl, unfold, memo)
+        case (("Π" | "Σ" | "λ") as head, dom, clo):
+            r = mk(head, readback(dom, lvl, unfold, memo),
+                readback_closure(clo, lvl, unfold, memo))
+        case ("@", fun, arg):
+            r = mk("@", readback(fun, lvl, unfold, memo), readback(arg, lvl, unfold, memo))
+        case (",", clo, fst, snd):
+            r = mk(",", readback_closure(clo, lvl, unfold, memo),
+                readback(fst, lvl, unfold, memo), readback(snd, lvl, unfold, memo))
+        case (("fst" | "snd") as head, pair):
+            r = mk(head, readback(pair, lvl, unfold, memo))
+        case (("Id" | "ap" | "trR" | "fillR") as head, clo,
+            left, right, eqs, *ends):
+            fam = readback_closure(clo, lvl, unfold, memo)
+            left, right, eqs = list(left), list(right), list(eqs)
+            while head in ("Id", "ap") and len(fam) > 2 and not occurs(fam[-1], 0):
+                # The last variable of the telescope is not used.
+                fam = mk(*fam[:-2], instantiate(mk("Bind", "_", fam[-1]), (mk("U"),)))
+                left.pop(); right.pop(); eqs.pop()
+            r = mk(head, fam,
+                mk("Telescope", *(readback(l, lvl, unfold, memo) for l in left)),
+                mk("Telescope", *(readback(r, lvl, unfold, memo) for r in right)),
+                mk("Telescope", *(readback(e, lvl, unfold, memo) for e in eqs)),
+                *(readback(e, lvl, unfold, memo) for e in ends))
+        case _:  # Free variables and constants
+            return hashcons(v)
+    if memo is not None:
+        memo[(id(v), lvl)] = (v, r)  # Keeps v alive, so that its id is not reused.
+    return r
+
+def normalize(t, delta=None, unfold=False):
+    """
+    Normalize the locally closed term t.
+    """
+    return readback(evaluate(t, None, delta), 0, unfold, {})
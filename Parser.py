@@ -1,5 +1,7 @@
 from functools import reduce
 from Core import *
+import codecs
+import re
 """
 head := Σ | Π | λ
 sc :=  <var> "/" <term> : <term> == <term>
@@ -12,7 +14,11 @@ term := <var> | <const>
     | fst <term> | snd <term>           ; maximal precedence, right-associative
     | Id [ <tele> . <type> ] [ <term> , <term> ]
     | ap [ <tele> . <term> ]
+    | let <var> = <term> in <term>      ; lowest precedence, like binders
 type := <term>
+
+parse and pretty work on the locally nameless core syntax, the numbered
+levels below them work on named terms.
 """  # wildcard _ doesn't bind
 
 VAR_CHARS = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789-_"
@@ -26,148 +32,197 @@ examples = [
     "f fst p q snd fst (p q)",  # f (fst p) q (snd (fst (p q)))
 ]
 
-def lex(string:str):
-    string = string.lstrip()
-    while string:
-        if string[0] in "(){}[].:;|,ΣΠλ=/*":
-            if string[0:2] in ("=>", "=="):
-                yield string[0:2]
-                string = string[2:]
-            else:
-                yield string[0]
-                string = string[1:]
+TOKEN = re.compile(r"""
+    (?P<space>\s+)
+  | (?P<sym>=>|==|[(){}\[\].:;|,ΣΠλ=/*])
+  | (?P<word>\\?[%s]+|\\)
+""" % re.escape(VAR_CHARS), re.VERBOSE)
+
+class LexError(RuntimeError):
+    """
+    An unexpected character. Unlike the SyntaxErrors of the parser, which it
+    backtracks on, it is never caught while parsing.
+    """
+
+def lex(string:str, start=0, line=1, col=1):
+    """
+    Yields (token, offset, line, column) in one pass over string.
+    """
+    pos = start
+    while pos < len(string):
+        m = TOKEN.match(string, pos)
+        if m is None:
+            raise LexError("Unexpected character '%s' at line %d, column %d"
+                % (string[pos], line, col))
+        tok = m.group()
+        if m.lastgroup != "space":
+            yield tok, pos, line, col
+        if (n := tok.count("\n")):
+            line += n
+            col = len(tok) - tok.rfind("\n")
         else:
-            k = 0
-            if string[0] == "\\":
-                k = 1
-            while k < len(string) and string[k] in VAR_CHARS:
-                k += 1
-            yield string[:k]
-            string = string[k:]
-        string = string.lstrip()
+            col += len(tok)
+        pos = m.end()
+
+def lex_file(f, chunk_size=1 << 16):
+    """
+    Yields the same as lex, reading f incrementally. f is a text or binary
+    (UTF-8) file object, or an mmap. Only the current chunk is kept.
+    """
+    decode = codecs.getincrementaldecoder("utf-8")().decode
+    buf, base, line, col = "", 0, 1, 1
+    while True:
+        data = f.read(chunk_size)
+        eof = not data
+        buf += decode(data, final=eof) if isinstance(data, bytes) else data
+        # Tokens never contain whitespace, so the buffer can be cut after it.
+        cut = len(buf) if eof else max(buf.rfind(c) for c in " \t\r\n") + 1
+        for tok, pos, line_, col_ in lex(buf[:cut], 0, line, col):
+            yield tok, base + pos, line_, col_
+        if (n := buf.count("\n", 0, cut)):
+            line += n
+            col = cut - buf.rfind("\n", 0, cut)
+        else:
+            col += cut
+        buf, base = buf[cut:], base + cut
+        if eof:
+            return
+
+class Tokens:
+    def __init__(self, source):
+        """
+        A stream of tokens, consumed by advancing a cursor. source is a string
+        or an iterator of lexed tokens (see lex and lex_file), which is only
+        read one token ahead of the parser. Errors report the current position.
+        """
+        self.source = lex(source) if isinstance(source, str) else iter(source)
+        self.tok = None
+        self.where = None  # (offset, line, column) of the current token
+        self.next()
+
+    def __bool__(self):
+        return self.tok is not None
+
+    def peek(self):
+        return self.tok
+
+    def next(self):
+        tok = self.tok
+        self.tok, *self.where = next(self.source, (None, None, None, None))
+        return tok
+
+    def error(self, msg, cls=RuntimeError):
+        if self.tok is not None:
+            _, line, col = self.where
+            msg = "%s, got '%s' at line %d, column %d" % (msg, self.tok, line, col)
+        else:
+            msg = "%s, got end of input" % msg
+        return cls(msg)
+
+    def expect(self, tok, cls=RuntimeError):
+        if self.tok != tok:
+            raise self.error("Expected '%s'" % tok, cls)
+        self.next()
 
 def scope_check(string):
-    if string in ("0", "1", "*", "absurd"):
-        return ("con", string)
+    if string in ("let", "in"):
+        return None
+    elif string in ("0", "1", "*", "absurd"):
+        return mk("con", string)
     elif string == "U":
-        return ("U",)
+        return mk("U")
     elif all(x in VAR_CHARS for x in string):
-        return ("Var", string)
+        return mk("Var", string)
 
 def parse0(tokens): # vars, consts, parens, Id, ap
-    match tokens[0]:
+    match tokens.peek():
         case "(":
-            tokens.pop(0)
-            expr, tokens = parse(tokens)
-            if tokens and tokens[0] == ")":
-                tokens.pop(0)
-                return expr, tokens
-            else:
-                raise SyntaxError("Expected ')', got '%s'" % tokens[0])
+            tokens.next()
+            expr, tokens = parse4(tokens)
+            tokens.expect(")")  # Not backtracked on, "(" is consumed.
+            return expr, tokens
         case "Id":
-            tokens.pop(0)
-            if tokens and tokens[0] == "[":
-                tokens.pop(0)
-            else:
-                raise RuntimeError("Expected '[', got '%s'" % tokens[0])
+            tokens.next()
+            tokens.expect("[")
             vs, left, right, eqs, tokens = parse_tele(tokens)
-            if tokens and tokens[0] == ".":
-                tokens.pop(0)
-            else:
-                raise RuntimeError("Expected '.', got '%s'" % tokens[0])
-            type, tokens = parse(tokens)
-            if tokens and tokens[0] == "]":
-                tokens.pop(0)
-            else:
-                raise RuntimeError("Expected ']', got '%s'" % tokens[0])
-            if tokens and tokens[0] == "[":
-                tokens.pop(0)
-            else:
-                raise RuntimeError("Expected '[', got '%s'" % tokens[0])
-            fst, tokens = parse(tokens)
-            if tokens and tokens[0] == ",":
-                tokens.pop(0)
-            else:
-                raise RuntimeError("Expected ',', got '%s'" % tokens[0])
-            snd, tokens = parse(tokens)
-            if tokens and tokens[0] == "]":
-                tokens.pop(0)
-            else:
-                raise RuntimeError("Expected ']', got '%s'" % tokens[0])
-            return ("Id", ("Bind", *vs, type),
-                ("Telescope", *left),
-                ("Telescope", *right),
-                ("Telescope", *eqs), fst, snd), tokens
+            tokens.expect(".")
+            type, tokens = parse4(tokens)
+            tokens.expect("]")
+            tokens.expect("[")
+            fst, tokens = parse4(tokens)
+            tokens.expect(",")
+            snd, tokens = parse4(tokens)
+            tokens.expect("]")
+            return mk("Id", mk("Bind", *vs, type),
+                mk("Telescope", *left),
+                mk("Telescope", *right),
+                mk("Telescope", *eqs), fst, snd), tokens
         case "ap":
-            tokens.pop(0)
-            if tokens and tokens[0] == "[":
-                tokens.pop(0)
-            else:
-                raise RuntimeError("Expected '[', got '%s'" % tokens[0])
+            tokens.next()
+            tokens.expect("[")
             vs, left, right, eqs, tokens = parse_tele(tokens)
-            if tokens and tokens[0] == ".":
-                tokens.pop(0)
-            else:
-                raise RuntimeError("Expected '.', got '%s'" % tokens[0])
-            type, tokens = parse(tokens)
-            if tokens and tokens[0] == "]":
-                tokens.pop(0)
-            else:
-                raise RuntimeError("Expected ']', got '%s'" % tokens[0])
-            return ("ap", ("Bind", *vs, type),
-                ("Telescope", *left),
-                ("Telescope", *right),
-                ("Telescope", *eqs)), tokens
-        case t if r := scope_check(t):
-            return r, tokens[1:]
+            tokens.expect(".")
+            type, tokens = parse4(tokens)
+            tokens.expect("]")
+            return mk("ap", mk("Bind", *vs, type),
+                mk("Telescope", *left),
+                mk("Telescope", *right),
+                mk("Telescope", *eqs)), tokens
+        case t if t is not None and (r := scope_check(t)):
+            tokens.next()
+            return r, tokens
         case _:
-            raise SyntaxError("Expected '(', got '%s'" % tokens[0])
+            raise tokens.error("Expected '('", SyntaxError)
+
+# The pretty printers return the pieces of their output: strings, layout
+# marks, and (printer, expr) pairs still to be printed, see layout.
+
+BREAK, NEST, UNNEST = range(3)  # A space or newline, and indenting what is between.
+ELIDED = "…"
 
 def pretty0(expr):
     match expr:
         case ("U",):
-            return "U"
+            return ["U"]
         case ("Var", var):
-            return pretty_Var(var)
+            return [pretty_Var(var)]
         case ("con", const):
-            return const
+            return [const]
         case ("Id", ("Bind", *vs, type),
                 ("Telescope", *left),
                 ("Telescope", *right),
                 ("Telescope", *eqs), fst, snd):
-            return "Id[%s . %s][%s, %s]" % (
-                pretty_tele(vs, left, right, eqs),
-                pretty(type),
-                pretty(fst),
-                pretty(snd)
-            )
+            return ["Id[", *pretty_tele(vs, left, right, eqs), " . ", (pretty4, type),
+                "][", (pretty4, fst), ", ", (pretty4, snd), "]"]
         case ("ap", ("Bind", *vs, type),
                 ("Telescope", *left),
                 ("Telescope", *right),
                 ("Telescope", *eqs)):
             left, right, eqs = (), (), () # tele(scope)
-            return "ap[%s . %s]" % (
-                pretty_tele(vs, left, right, eqs),
-                pretty(type)
-            )
+            return ["ap[", *pretty_tele(vs, left, right, eqs), " . ", (pretty4, type), "]"]
         case _:
-            return "(%s)" % pretty(expr)
+            return ["(", NEST, (pretty4, expr), UNNEST, ")"]
 
 def parse1(tokens):  # fst and snd
     toks = []
-    while tokens and tokens[0] in ("fst", "snd"):
-        toks.append(tokens.pop(0))
-    expr, tokens = parse0(tokens)
+    while tokens.peek() in ("fst", "snd"):
+        toks.append(tokens.next())
+    try:
+        expr, tokens = parse0(tokens)
+    except SyntaxError as e:
+        if toks:  # Not backtracked on, the projections are consumed.
+            raise RuntimeError(str(e)) from None
+        raise
     while toks:
-        expr = (toks.pop(), expr)
+        expr = mk(toks.pop(), expr)
     return expr, tokens
 
 def pretty1(expr):
-    string = ""
+    pieces = []
     while expr[0] in ("fst", "snd"):
-        string += expr[0] + " "
+        pieces.append(expr[0] + " ")
         expr = expr[1]
-    return string + pretty0(expr)
+    return pieces + [(pretty0, expr)]
 
 def parse2(tokens):  # application
     exprs = []
@@ -177,62 +232,56 @@ def parse2(tokens):  # application
         except SyntaxError:
             break
         exprs.append(expr)
-    return reduce(lambda x, y: ("@", x, y), exprs), tokens
+    if not exprs:
+        raise tokens.error("Expected a term")
+    return reduce(lambda x, y: mk("@", x, y), exprs), tokens
 
 def pretty2(expr):
-    if expr[0] == "@":
-        return pretty2(expr[1]) + " " + pretty1(expr[2])
-    else:
-        return pretty1(expr)
+    args = []
+    while expr[0] == "@":
+        args.append(expr[2])
+        expr = expr[1]
+    pieces = [(pretty1, expr)]
+    for arg in reversed(args):
+        pieces += [BREAK, (pretty1, arg)]
+    return pieces
 
 def parse3(tokens):  # dependent pair
     fst, tokens = parse2(tokens)
-    if tokens and tokens[0] == "{":
-        tokens.pop(0)
+    if tokens.peek() == "{":
+        tokens.next()
     else:
         return fst, tokens  # !
-    v = scope_check(tokens.pop(0))
-    if not v or v[0] != "Var":
-        raise RuntimeError("Expected variable, got '%s'" % tokens[0])
-    v = v[1]
-    if tokens and tokens[0] == "=>":
-        tokens.pop(0)
-    else:
-        raise RuntimeError("Expected '=>', got '%s'" % tokens[0])
-    body, tokens = parse(tokens)
-    if tokens and tokens[0] == "}":
-        tokens.pop(0)
-    else:
-        raise RuntimeError("Expected '}', got '%s'" % tokens[0])
+    v = parse_var(tokens)
+    tokens.expect("=>")
+    body, tokens = parse4(tokens)
+    tokens.expect("}")
     snd, tokens = parse2(tokens)
-    return (",", ("Bind", v, body), fst, snd), tokens
+    return mk(",", mk("Bind", v, body), fst, snd), tokens
 
 def pretty3(expr):
     match expr:
         case (",", ("Bind", v, body), fst, snd):
-            return "%s { %s => %s } %s" % (pretty2(fst), pretty_Var(v), pretty(body), pretty3(snd))
+            return [(pretty2, fst), " { %s => " % pretty_Var(v), (pretty4, body), " } ",
+                (pretty3, snd)]
         case _:
-            return pretty2(expr)
+            return [(pretty2, expr)]
 
-def parse_sc(tokens):
-    v = scope_check(tokens[0])
+def parse_var(tokens, cls=RuntimeError):
+    v = scope_check(tokens.peek() or "")
     if not v or v[0] != "Var":
-        raise SyntaxError("Expected variable, got '%s'" % tokens[0])
-    tokens.pop(0)
-    v = v[1]
-    if tokens.pop(0) != "/":
-        raise RuntimeError("Expected '/', got '%s'" % tokens[1])
-    t, tokens = parse(tokens)
-    if tokens and tokens[0] == ":":
-        tokens.pop(0)
-    else:
-        raise RuntimeError("Expected ':', got '%s'" % tokens[0])
-    body, tokens = parse(tokens)
-    if tokens and tokens[0] == "==":
-        tokens.pop(0)
-    else:
-        raise RuntimeError("Expected '==', got '%s'" % tokens[0])
-    body2, tokens = parse(tokens)
+        raise tokens.error("Expected variable", cls)
+    tokens.next()
+    return v[1]
+
+def parse_sc(tokens):
+    v = parse_var(tokens, SyntaxError)
+    tokens.expect("/")
+    t, tokens = parse4(tokens)
+    tokens.expect(":")
+    body, tokens = parse4(tokens)
+    tokens.expect("==")
+    body2, tokens = parse4(tokens)
     return v, t, body, body2, tokens
 
 def parse_tele(tokens):
@@ -249,98 +298,300 @@ def parse_tele(tokens):
             eqs.append(t)
         except SyntaxError:
             break
-        if not tokens or tokens[0] != ";":
+        if tokens.peek() != ";":
             break
-        tokens.pop(0)
+        tokens.next()
     return vs, left, right, eqs, tokens
 
 def pretty_tele(var, left, right, eqs):
-    return " ; ".join("%s / %s : %s == %s" % (pretty_Var(v), pretty(e), pretty(l), pretty(r))
-            for v, l, r, e in zip(var, left, right, eqs))
+    pieces = []
+    for v, l, r, e in zip(var, left, right, eqs):
+        pieces += [" ; " if pieces else "", "%s / " % pretty_Var(v), (pretty4, e),
+            " : ", (pretty4, l), " == ", (pretty4, r)]
+    return pieces
 
 def parse_binder(tokens):
-    if tokens and tokens[0] == "(":
-        tokens.pop(0)
-    else:
-        raise SyntaxError("Expected '(', got '%s'" % tokens[0])
-    v = scope_check(tokens.pop(0))
-    if not v or v[0] != "Var":
-        raise RuntimeError("Expected variable, got '%s'" % tokens[0])
-    v = v[1]
-    if tokens and tokens[0] == ":":
-        tokens.pop(0)
-    else:
-        raise RuntimeError("Expected ':', got '%s'" % tokens[0])
-    t, tokens = parse(tokens)
-    if tokens and tokens[0] == ")":
-        tokens.pop(0)
-    else:
-        raise RuntimeError("Expected ')', got '%s'" % tokens[0])
+    tokens.expect("(", SyntaxError)
+    v = parse_var(tokens)
+    tokens.expect(":")
+    t, tokens = parse4(tokens)
+    tokens.expect(")")
     return (v, t), tokens
 
 def parse_binders(tokens):
     binders = []
-    while tokens and tokens[0] in "ΣΠλ":
-        head = tokens.pop(0)
+    while tokens.peek() in ("Σ", "Π", "λ"):
+        head = tokens.next()
         while tokens:
             try:
                 binder, tokens = parse_binder(tokens)
             except SyntaxError:
                 break
             binders.append((head, *binder))
-        if tokens and tokens[0] == "=>":
-            tokens.pop(0)
+        if tokens.peek() == "=>":
+            tokens.next()
     return binders, tokens
 
-def parse(tokens):  # binders
-    binders, tokens = parse_binders(tokens)
+def parse4(tokens):  # binders and lets
+    binders = []
+    while True:
+        bs, tokens = parse_binders(tokens)
+        binders += bs
+        if tokens.peek() != "let":
+            break
+        tokens.next()
+        v = parse_var(tokens)
+        tokens.expect("=")
+        value, tokens = parse4(tokens)
+        tokens.expect("in")
+        binders.append(("let", v, value))
     expr, tokens = parse3(tokens)
     while binders:
         hd, v, ty = binders.pop()
-        expr = (hd, ty, ("Bind", v, expr))
+        expr = mk(hd, ty, mk("Bind", v, expr))
     return expr, tokens
 
-def pretty(expr):
-    string = ""
+def pretty4(expr):
+    pieces = []
     current = ""
     while expr[0] in "ΣΠλ":
         if expr[0] != current:
-            string += expr[0] + " "
+            pieces.append(expr[0] + " ")
             current = expr[0]
         (_, ty, (_, v, expr)) = expr
-        string += "(%s : %s) " % (pretty_Var(v), pretty(ty))
-    return (string + "=> " if string else "") + pretty3(expr)
+        pieces += ["(%s : " % pretty_Var(v), (pretty4, ty), ")", BREAK]
+    if expr[0] == "let":
+        return pieces + ["=>" if pieces else "", NEST, BREAK if pieces else "",
+            *pretty_lets(expr), UNNEST]
+    if not pieces:
+        return [(pretty3, expr)]
+    return pieces + ["=>", NEST, BREAK, (pretty3, expr), UNNEST]
+
+def pretty_lets(expr):
+    # The lets made by abbreviate, ("let", x, value, body).
+    pieces = []
+    while expr[0] == "let":
+        _, x, value, expr = expr
+        pieces += ["let %s = " % pretty_Var(x), NEST, (pretty4, value), UNNEST, BREAK,
+            "in", BREAK]
+    return pieces + [(pretty4, expr)]
+
+def abbreviate(expr, min_size=8):
+    """
+    Replace the subterms of the locally nameless term expr that occur more
+    than once, and have at least min_size nodes, by variables bound by lets
+    ("let", x, value, body). A subterm only occurs twice if it means the same
+    both times: its loose indices must refer to the same binders. The let is
+    put at the top of the body of the innermost binder around the subterm,
+    or at the top of the term if it is locally closed. Each distinct subterm
+    is visited once, with explicit stacks. The result is only meant to be
+    printed, the lets parse back as ("let", value, ("Bind", x, body)).
+    """
+    expr = hashcons(expr)
+    # A subterm is keyed by its node, and the innermost Bind around it (by
+    # number) if it has loose indices.
+    index, terms, scopes, refs, order = {}, [], [], [], []
+    stack = [(expr, None)]
+    while stack:
+        t, scope = stack.pop()
+        if type(t) is int:
+            order.append(t)
+            continue
+        key = (id(t), scope if loose(t) else None)
+        if (i := index.get(key)) is not None:
+            refs[i] += 1
+            continue
+        i = index[key] = len(terms)
+        terms.append(t)
+        scopes.append(key[1])
+        refs.append(1)
+        stack.append((i, None))
+        inner = i if t[0] == "Bind" else key[1]
+        stack.extend((c, inner) for c in reversed(t[1:]) if type(c) is tuple)
+    def children(i):
+        t = terms[i]
+        inner = i if t[0] == "Bind" else scopes[i]
+        return [index[(id(c), inner if loose(c) else None)] if type(c) is tuple else c
+            for c in t[1:]]
+    sizes, names, lets = {}, {}, {}
+    # Let names avoid the binders too, which would otherwise be renamed.
+    taken = freevar(expr) | {x for t in terms if t[0] == "Bind" for x in t[1:-1]}
+    count = 0
+    for i in order:
+        sizes[i] = 1 + sum(sizes[j] for j, c in zip(children(i), terms[i][1:])
+            if type(c) is tuple)
+        if refs[i] > 1 and sizes[i] >= min_size and terms[i][0] not in ("Bind", "Telescope"):
+            count += 1
+            while "s%d" % count in taken:
+                count += 1
+            names[i] = "s%d" % count
+            lets.setdefault(scopes[i], []).append(i)
+    out = {}
+    def wrap(scope, body):
+        for i in reversed(lets.get(scope, ())):
+            body = ("let", names[i], out[i], body)
+        return body
+    for i in order:
+        t = terms[i]
+        ts = [(("Var", names[j]) if j in names else out[j]) if type(c) is tuple else c
+            for j, c in zip(children(i), t[1:])]
+        if t[0] == "Bind":
+            ts[-1] = wrap(i, ts[-1])
+        out[i] = t if all(a is b for a, b in zip(ts, t[1:])) else (t[0], *ts)
+    return wrap(None, out[index[(id(expr), None)]])
+
+class Writer:
+    """
+    Writes text with write as it comes, without line breaks, or filling lines
+    up to width: a BREAK becomes a newline when the text up to the next one
+    does not fit on the line, so only that text is held back.
+    """
+    def __init__(self, write, width=None):
+        self.write = write
+        self.width = width
+        self.column = 0
+        self.indent = 0
+        self.pending = None  # The indent of the held back break, if any.
+        self.held = []
+        self.size = 0
+
+    def text(self, string):
+        if self.pending is None:
+            self.write(string)
+            self.column += len(string)
+            return
+        self.held.append(string)
+        self.size += len(string)
+        if self.column + 1 + self.size > self.width:
+            self.flush()
+
+    def mark(self, mark):
+        if mark == NEST:
+            self.indent += 2
+        elif mark == UNNEST:
+            self.indent -= 2
+        elif self.width is None:
+            self.text(" ")
+        else:
+            self.flush()
+            self.pending = self.indent
+
+    def flush(self):
+        if self.pending is None:
+            return
+        if self.column + 1 + self.size > self.width and self.column > self.pending:
+            self.write("\n" + " " * self.pending)
+            self.column = self.pending
+        else:
+            self.write(" ")
+            self.column += 1
+        self.write("".join(self.held))
+        self.column += self.size
+        self.pending, self.held, self.size = None, [], 0
+
+def layout(expr, write, printer=pretty4, width=None, nodes=None, depth=None):
+    """
+    Print the named term expr at the level of printer with write, in one
+    pass with an explicit stack. Lines are filled up to width if it is given.
+    Subterms after the first nodes ones, or deeper than depth, are elided.
+    """
+    writer = Writer(write, width)
+    work = [(printer, expr, 0, True)]
+    count = 0
+    while work:
+        piece = work.pop()
+        if type(piece) is str:
+            writer.text(piece)
+        elif type(piece) is int:
+            writer.mark(piece)
+        else:
+            printer, expr, level, new = piece
+            count += new
+            if nodes is not None and count > nodes or depth is not None and level > depth:
+                writer.text(ELIDED)
+                continue
+            for p in reversed(printer(expr)):
+                if type(p) is tuple:
+                    p = (*p, level + (p[1] is not expr), p[1] is not expr)
+                work.append(p)
+    writer.flush()
+
+def parse(tokens):  # locally nameless boundary
+    expr, tokens = parse4(tokens)
+    return to_nameless(expr), tokens
+
+def pretty(expr, out=None, width=None, nodes=None, depth=None, share=False):  # locally nameless boundary
+    """
+    The text of expr, or None after writing it to the stream out. Repeated
+    subterms are printed once as lets if share is set, see abbreviate. See
+    layout for the other options.
+    """
+    expr = from_nameless(abbreviate(expr) if share else expr)
+    if out is not None:
+        return layout(expr, out.write, width=width, nodes=nodes, depth=depth)
+    pieces = []
+    layout(expr, pieces.append, width=width, nodes=nodes, depth=depth)
+    return "".join(pieces)
 
 def parse_statement(tokens):
-    match tokens[0]:
+    match tokens.peek():
         case "\\constant":
-            tokens.pop(0)
-            v = scope_check(tokens.pop(0))
-            if not v or v[0] != "Var":
-                raise RuntimeError("Expected variable, got '%s'" % tokens[0])
-            v = v[1]
+            tokens.next()
+            v = parse_var(tokens)
             expr, tokens = parse(tokens)
             return ("\\constant", v, expr), tokens
         case "\\define":
-            tokens.pop(0)
-            v = scope_check(tokens.pop(0))
-            if not v or v[0] != "Var":
-                raise RuntimeError("Expected variable, got '%s'" % tokens[0])
-            v = v[1]
+            tokens.next()
+            v = parse_var(tokens)
             expr, tokens = parse(tokens)
             return ("\\define", v, expr), tokens
         case "\\infer":
-            tokens.pop(0)
+            tokens.next()
             expr, tokens = parse(tokens)
             return ("\\infer", expr), tokens
+        case "\\normalize":
+            tokens.next()
+            expr, tokens = parse(tokens)
+            return ("\\normalize", expr), tokens
+        case "\\rule":  # \rule name (x : A) ... => lhs = rhs
+            tokens.next()
+            v = parse_var(tokens)
+            xs, tys = (), []
+            while tokens.peek() != "=>":
+                (x, ty), tokens = parse_binder(tokens)
+                tys.append(to_nameless(ty, xs))
+                xs += (x,)
+            tokens.next()
+            lhs, tokens = parse4(tokens)
+            tokens.expect("=")
+            rhs, tokens = parse4(tokens)
+            return ("\\rule", v, mk("Telescope", *tys),
+                mk("Bind", *xs, to_nameless(lhs, xs)),
+                mk("Bind", *xs, to_nameless(rhs, xs))), tokens
+        case _:
+            raise tokens.error("Expected a statement")
+
+def parse_term(string):
+    """
+    Parses a whole string as a single term.
+    """
+    expr, tokens = parse(Tokens(string))
+    if tokens:
+        raise tokens.error("Expected end of input")
+    return expr
 
-def file_parse(string):
-    tokens = list(lex(string))
+def file_parse(source):
+    """
+    Yields the statements of source one at a time, so that they can be
+    checked while the rest is still unread. source is a string, or a file
+    object or mmap that is read incrementally.
+    """
+    tokens = Tokens(source if isinstance(source, str) else lex_file(source))
     while tokens:
         statement, tokens = parse_statement(tokens)
         yield statement
 
 if __name__ == "__main__":
     for ex in examples:
-        expr, tk = parse(list(lex(ex)))
+        expr, tk = parse(Tokens(ex))
         print(pretty(expr))
@@ -0,0 +1,142 @@
+"""
+Persistent (immutable) maps, for the tables of the checker.
+
+Map.set and Map.update return a new map that shares all but a path of nodes
+with the old one, which stays as it was. Keeping a version of a map around,
+e.g. as a snapshot of a context, is therefore free, and no undoing is needed
+to go back to it.
+
+Maps are hash array mapped tries: each level of nodes is indexed by the next
+5 bits of the hash of the keys. Nodes are Lisp style tuples:
+
+("Leaf", hash, key, value)
+("Collision", hash, ((key, value), ...)) : Keys with the same hash.
+("Node", bitmap, children)                : Bit k of bitmap is set if the
+                                            children have the entries whose
+                                            next 5 bits are k, in order.
+"""
+
+BITS = 5
+MASK = (1 << BITS) - 1
+HASH = (1 << 64) - 1  # Hashes are taken as 64 bit unsigned integers.
+
+def _index(bitmap, bit):
+    return (bitmap & (bit - 1)).bit_count()
+
+def _set(node, shift, h, key, value):
+    # The node with key set to value, and whether key is new.
+    if node is None:
+        return ("Leaf", h, key, value), True
+    match node:
+        case ("Leaf", h1, key1, _) if h1 == h:
+            if key1 == key:
+                return ("Leaf", h, key, value), False
+            return ("Collision", h, ((key1, node[3]), (key, value))), True
+        case ("Collision", h1, pairs) if h1 == h:
+            for k, (key1, _) in enumerate(pairs):
+                if key1 == key:
+                    return ("Collision", h, pairs[:k] + ((key, value),) + pairs[k + 1:]), False
+            return ("Collision", h, pairs + ((key, value),)), True
+        case ("Leaf" | "Collision", h1, *_):
+            # Push the node one level down, where the hashes differ or
+            # will differ further down.
+            node = ("Node", 1 << ((h1 >> shift) & MASK), (node,))
+    _, bitmap, children = node
+    bit = 1 << ((h >> shift) & MASK)
+    k = _index(bitmap, bit)
+    if bitmap & bit:
+        child, new = _set(children[k], shift + BITS, h, key, value)
+        return ("Node", bitmap, children[:k] + (child,) + children[k + 1:]), new
+    return ("Node", bitmap | bit, children[:k] + (("Leaf", h, key, value),) + children[k:]), True
+
+class Map:
+    __slots__ = ("root", "size")
+
+    def __init__(self, items=()):
+        """
+        A persistent map with the (key, value) pairs items, or the items of
+        a mapping.
+        """
+        self.root = None
+        self.size = 0
+        if items:
+            m = Map().update(items)
+            self.root, self.size = m.root, m.size
+
+    def _replace(self, root, size):
+        m = Map()
+        m.root, m.size = root, size
+        return m
+
+    def get(self, key, default=None):
+        h = hash(key) & HASH
+        node = self.root
+        shift = 0
+        while node is not None:  # Indexing rather than match, lookups are hot.
+            if node[0] == "Node":
+                bitmap = node[1]
+                bit = 1 << ((h >> shift) & MASK)
+                if not bitmap & bit:
+                    return default
+                node = node[2][_index(bitmap, bit)]
+                shift += BITS
+            elif node[1] != h:
+                return default
+            elif node[0] == "Leaf":
+                return node[3] if node[2] == key else default
+            else:
+                for key1, value in node[2]:
+                    if key1 == key:
+                        return value
+                return default
+        return default
+
+    def __getitem__(self, key):
+        missing = []  # Only this object is never a value.
+        if (value := self.get(key, missing)) is missing:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        missing = []
+        return self.get(key, missing) is not missing
+
+    def __len__(self):
+        return self.size
+
+    def set(self, key, value):
+        """
+        The map with key set to value.
+        """
+        root, new = _set(self.root, 0, hash(key) & HASH, key, value)
+        return self._replace(root, self.size + new)
+
+    def update(self, items):
+        """
+        The map with the (key, value) pairs items, or the items of a mapping,
+        set in order.
+        """
+        if hasattr(items, "items"):
+            items = items.items()
+        root, size = self.root, self.size
+        for key, value in items:
+            root, new = _set(root, 0, hash(key) & HASH, key, value)
+            size += new
+        return self._replace(root, size)
+
+    def items(self):
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            match stack.pop():
+                case ("Leaf", _, key, value):
+                    yield key, value
+                case ("Collision", _, pairs):
+                    yield from pairs
+                case ("Node", _, children):
+                    stack.extend(reversed(children))
+
+    def __iter__(self):
+        return (key for key, _ in self.items())
+
+    def __repr__(self):
+        return "Map(%r)" % dict(self.items())
@@ -0,0 +1,130 @@
+from Core import *
+from Core import _rebuild
+from collections import Counter
+"""
+Rewrite rules, indexed by the head constructor of the terms they rewrite, so
+that a term is only tried against the rules for its own head.
+
+A rule is a function taking the term (and whatever else the caller of
+Rules.rewrite passes along) and returning the rewritten term, or None if it
+does not apply. Rules are tried in the order they were added.
+"""
+
+class Rules:
+    def __init__(self):
+        self.heads = {}  # Lists of (name, rule), keyed by head.
+        self.hits = Counter()  # How often each rule has fired, by name.
+
+    def add(self, head, name, rule):
+        if any(name == n for rules in self.heads.values() for n, _ in rules):
+            raise ValueError("Rule already exists: " + name)
+        self.heads.setdefault(head, []).append((name, rule))
+
+    def register(self, head, name=None):
+        """
+        Decorator adding a rule for terms with the given head.
+        """
+        def decorator(rule):
+            self.add(head, name or rule.__name__, rule)
+            return rule
+        return decorator
+
+    def copy(self):
+        """
+        The same rules, with fresh hit counters.
+        """
+        rules = Rules()
+        rules.heads = {head : list(rs) for head, rs in self.heads.items()}
+        return rules
+
+    def rewrite(self, expr, *args):
+        for name, rule in self.heads.get(expr[0], ()):
+            if (re := rule(expr, *args)) is not None:
+                self.hits[name] += 1
+                return re
+
+def normal_form(expr, rewrite):
+    """
+    The normal form of the canonical term expr, rewriting innermost first,
+    from left to right, with rewrite, which returns None on normal forms.
+    An explicit stack is used instead of recursion, and shared subterms are
+    only normalized once.
+    """
+    nfs = {}  # Normal forms of the subterms done, keyed by id.
+    reducts = {}  # What the subterms in progress were rewritten to.
+    stack = [expr]
+    while stack:
+        t = stack[-1]
+        if id(t) in nfs:
+            stack.pop()
+            continue
+        if (re := reducts.get(id(t))) is not None:
+            nfs[id(t)] = nfs[id(re)]
+            stack.pop()
+            continue
+        n = len(stack)
+        for c in reversed(t):  # The leftmost child ends up on top.
+            if type(c) is tuple and id(c) not in nfs:
+                stack.append(c)
+        if len(stack) > n:
+            continue
+        r = _rebuild(t, [nfs[id(c)] if type(c) is tuple else c for c in t[1:]])
+        if (re := rewrite(r)) is None:
+            nfs[id(t)] = nfs[id(r)] = r
+            stack.pop()
+        else:
+            reducts[id(t)] = re = hashcons(re)
+            stack.append(re)
+    return nfs[id(expr)]
+
+def match_pattern(pat, t, depth, sol, whnf=None):
+    """
+    Match the term t against pat, under depth binders. The loose indices of
+    pat are the pattern variables, ("Idx", depth + k) is the k-th one, and
+    they are solved in sol. Pattern variables only match locally closed
+    terms, and a variable ("Var", x) also matches the constant ("con", x).
+    If whnf is given, subterms of t that do not match are reduced with it
+    and tried again.
+    """
+    solved = dict(sol)
+    if _match(pat, t, depth, sol, whnf):
+        return True
+    if whnf is None or (pat[0] == "Idx" and pat[1] >= depth):
+        return False
+    sol.clear()  # Forget what the failed attempt solved.
+    sol.update(solved)
+    return (r := whnf(t)) is not t and _match(pat, r, depth, sol, whnf)
+
+def _match(pat, t, depth, sol, whnf):
+    match pat, t:
+        case ("Idx", i), _ if i >= depth:
+            if loose(t):
+                return False
+            if (s := sol.get(i - depth)) is not None:
+                return s is hashcons(t)
+            sol[i - depth] = hashcons(t)
+            return True
+        case ("Var", x), ("con", y):
+            return x == y
+        case ("Bind", *xs, body), ("Bind", *ys, tbody):
+            return len(xs) == len(ys) and \
+                match_pattern(body, tbody, depth + len(xs), sol, whnf)
+        case (head, *ps), (thead, *ts) if head == thead and len(ps) == len(ts):
+            return all(match_pattern(p, c, depth, sol, whnf) if isinstance(p, tuple)
+                else p == c for p, c in zip(ps, ts))
+        case _:
+            return False
+
+def pattern_rule(lhs, rhs):
+    """
+    The rule rewriting instances of lhs into the same instances of rhs, for
+    a Checker. lhs and rhs are Binds over the same pattern variables, which
+    must all occur in lhs. Subterms are put in weak head normal form as far
+    as the match needs it.
+    """
+    n = len(lhs) - 2
+    def rule(expr, checker, unfold):
+        sol = {}
+        if _match(lhs[-1], expr, 0, sol, lambda t: checker.whnf(t, unfold)):
+            return instantiate(rhs, [sol[n - 1 - k] for k in range(n)])
+    return rule
@@ -0,0 +1,196 @@
+from Core import *
+import Core
+from Parser import pretty, parse_term, file_parse
+from Checker import Checker, BUILTINS, check_statements
+import inspect
+import json
+import time
+"""
+A checker daemon, answering JSON-RPC 2.0 requests, one per line, over stdio or
+a Unix socket. The definitions, constants and caches stay warm between
+requests, so each request only costs the new work.
+
+Terms are passed and returned in the concrete syntax. Methods:
+
+define    {name, term}          -> {type}
+infer     {term}                -> {type}
+normalize {term, unfold=false}  -> {term}
+check     {term, type}          -> {}
+load      {source}              -> {results}, the results of \\infer and
+                                   \\normalize statements in source.
+
+Every result also has the time spent on the request, in seconds, and the
+conversion problems it postponed, if any (strict servers fail on them instead).
+
+Hash-consed nodes are kept for as long as the server runs, so that the caches
+stay warm. Once there are more than max_nodes of them, they are dropped with
+the normal forms cached for them after the request.
+"""
+
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+CHECK_ERROR = -32000
+
+class RPCError(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+class Server:
+    def __init__(self, engine="subst", strict=False, max_nodes=1000000):
+        self.checker = Checker(dict(BUILTINS), engine, strict=strict)
+        self.max_nodes = max_nodes
+        self.methods = {
+            "define" : self.define,
+            "infer" : self.infer,
+            "normalize" : self.normalize,
+            "check" : self.check,
+            "load" : self.load,
+        }
+
+    def define(self, name, term):
+        ty = self.checker.define(name, parse_term(term))
+        return {"type" : pretty(ty)}
+
+    def infer(self, term):
+        return {"type" : pretty(self.checker.infer(parse_term(term)))}
+
+    def normalize(self, term, unfold=False):
+        return {"term" : pretty(self.checker.normalize(parse_term(term), unfold))}
+
+    def check(self, term, type):
+        self.checker.check(parse_term(term), parse_term(type))
+        return {}
+
+    def load(self, source):
+        """
+        Runs the statements of source in order. The statements before a
+        failing one stay in effect.
+        """
+        results = []
+        for command, result in check_statements(self.checker, file_parse(source)):
+            if command[0] in ("\\infer", "\\normalize"):
+                results.append(pretty(result))
+        return {"results" : results}
+
+    def call(self, request):
+        """
+        Runs a single decoded request and returns its result.
+        """
+        if not isinstance(request, dict) or request.get("jsonrpc") != "2.0" \
+            or not isinstance(request.get("method"), str):
+            raise RPCError(INVALID_REQUEST, "Invalid request")
+        if (method := self.methods.get(request["method"])) is None:
+            raise RPCError(METHOD_NOT_FOUND, "Unknown method: " + request["method"])
+        params = request.get("params", {})
+        try:
+            match params:
+                case dict():
+                    inspect.signature(method).bind(**params)
+                case list():
+                    inspect.signature(method).bind(*params)
+                case _:
+                    raise TypeError("params must be an object or an array")
+        except TypeError as e:
+            raise RPCError(INVALID_PARAMS, str(e))
+        start = time.perf_counter()
+        self.checker.postponed.clear()  # Only those of this request are reported.
+        try:
+            result = method(**params) if isinstance(params, dict) else method(*params)
+        except RecursionError:
+            raise RPCError(CHECK_ERROR, "Maximum recursion depth exceeded")
+        except Exception as e:  # Errors of the checker and the parser.
+            raise RPCError(CHECK_ERROR, "%s: %s" % (type(e).__name__, e))
+        finally:
+            if len(Core.interned) > self.max_nodes:
+                reset_tables()
+                self.checker.cache.clear()
+        result["time"] = time.perf_counter() - start
+        if problems := self.checker.postponed:
+            result["postponed"] = [str(p) for p in problems]
+        return result
+
+    def respond(self, request):
+        """
+        The response to a decoded request, or None for notifications.
+        """
+        id = request.get("id") if isinstance(request, dict) else None
+        try:
+            response = {"jsonrpc" : "2.0", "id" : id, "result" : self.call(request)}
+        except RPCError as e:
+            response = {"jsonrpc" : "2.0", "id" : id,
+                "error" : {"code" : e.code, "message" : str(e)}}
+        if isinstance(request, dict) and "id" not in request:
+            return None
+        return response
+
+    def handle(self, line):
+        """
+        The response to a line of JSON, or None if there is nothing to send.
+        A line may hold a batch of requests.
+        """
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            return json.dumps({"jsonrpc" : "2.0", "id" : None,
+                "error" : {"code" : PARSE_ERROR, "message" : str(e)}})
+        if isinstance(request, list) and request:
+            responses = [r for r in map(self.respond, request) if r is not None]
+            return json.dumps(responses, ensure_ascii=False) if responses else None
+        if (response := self.respond(request)) is not None:
+            return json.dumps(response, ensure_ascii=False)
+
+    def serve(self, input, output):
+        for line in input:
+            if line.strip() and (response := self.handle(line)) is not None:
+                output.write(response + "\n")
+                output.flush()
+
+def serve_stdio(server):
+    import sys
+    server.serve(sys.stdin, sys.stdout)
+
+def serve_unix(server, path):
+    """
+    Serves one client at a time on the Unix socket at path, so that the
+    clients share the checker without locking.
+    """
+    import io, os, socketserver, stat
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            server.serve(io.TextIOWrapper(self.rfile, encoding="utf-8"),
+                io.TextIOWrapper(self.wfile, encoding="utf-8"))
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):  # Left over from an earlier run.
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
+    with socketserver.UnixStreamServer(path, Handler) as unix_server:
+        try:
+            unix_server.serve_forever()
+        finally:
+            os.unlink(path)
+
+if __name__ == "__main__":
+    import argparse
+    argparser = argparse.ArgumentParser(
+        description="Answers checking requests as JSON-RPC, over stdio by default.")
+    argparser.add_argument("--socket", metavar="PATH",
+        help="listen on the Unix socket at PATH instead")
+    argparser.add_argument("--engine", choices=("subst", "nbe"), default="subst")
+    argparser.add_argument("--strict", action="store_true",
+        help="fail on conversion problems that cannot be decided")
+    argparser.add_argument("--max-nodes", type=int, default=1000000, metavar="N",
+        help="drop the hash-consed nodes and cached normal forms when there "
+            "are more than N nodes (default: %(default)s)")
+    args = argparser.parse_args()
+    server = Server(args.engine, args.strict, args.max_nodes)
+    try:
+        if args.socket:
+            serve_unix(server, args.socket)
+        else:
+            serve_stdio(server)
+    except KeyboardInterrupt:
+        pass
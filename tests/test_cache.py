@@ -0,0 +1,59 @@
+from Cache import StatementCache
+from Checker import Checker, BUILTINS, check_statements, check_parallel
+from Core import alpha, mk
+from Parser import file_parse, parse_term, pretty
+import json
+import pickle
+
+# j postpones a conversion problem, so it is never cached, while i is.
+SOURCE = """
+\\define j λ (A : U) (B : U) (a : A) (f : Π (x : B) => U) => f ap[.a]
+\\define i λ (A : U) => j
+"""
+
+def run(path, source, check, **kwargs):
+    checker = Checker(dict(BUILTINS))
+    cache = StatementCache(str(path), repr(sorted(checker.constants.items())))
+    results = [r for _, r in check(checker, file_parse(source), cache=cache, **kwargs)]
+    cache.save()
+    return results, cache
+
+def test_parallel_reuses_dependent_of_uncached(tmp_path):
+    path = tmp_path / "cache"
+    first, _ = run(path, SOURCE + "\\infer i\n", check_statements)
+    results, cache = run(path, SOURCE + "\\infer i U\n", check_parallel, workers=2)
+    assert all(map(alpha, results[:2], first[:2]))
+    assert alpha(results[2], parse_term("Π (A : U) (B : U) (a : A) (f : Π (x : B) => U) => U"))
+    assert cache.reused + cache.checked == 3
+
+def test_sequential_and_parallel_agree(tmp_path):
+    source = SOURCE + "\\infer i\n"
+    sequential, _ = run(tmp_path / "a", source, check_statements)
+    parallel, _ = run(tmp_path / "b", source, check_parallel, workers=2)
+    assert all(map(alpha, sequential, parallel))
+
+def test_cached_results_print_the_same(tmp_path):
+    source = SOURCE + "\\infer i\n"
+    first, _ = run(tmp_path / "cache", source, check_statements)
+    second, cache = run(tmp_path / "cache", source, check_statements)
+    assert cache.reused == 2
+    assert list(map(pretty, first)) == list(map(pretty, second))
+    assert pretty(second[2]) == "Π (A : U) (A : U) (B : U) (a : A) (f : Π (x : B) => U) => U"
+
+def test_deep_results(tmp_path):
+    term = mk("U")
+    for _ in range(100000):
+        term = mk("λ", mk("U"), mk("Bind", "A", term))
+    cache = StatementCache(str(tmp_path / "cache"))
+    key = cache.key(("\\define", "d", term), [])
+    cache[key] = term
+    cache.save()
+    cache = StatementCache(str(tmp_path / "cache"))
+    assert cache.get(key) is term
+
+def test_not_a_cache(tmp_path):
+    path = tmp_path / "cache"
+    path.write_bytes(pickle.dumps({"key" : ("U",)}))
+    results, cache = run(path, SOURCE, check_statements)
+    assert cache.reused == 0 and cache.checked == 2
+    assert json.loads(path.read_text())["entries"]
@@ -0,0 +1,43 @@
+import pytest
+from Core import mk, bind, from_nameless, alpha, to_nameless
+from Parser import parse_term, pretty
+
+def test_unused_wildcards_stay():
+    t = parse_term("λ (x : U) => " + "Π (_ : x) => " * 2000 + "x")
+    named = from_nameless(t)
+    assert alpha(to_nameless(named), t)
+    body = named[-1][-1]
+    for _ in range(2000):
+        assert body[0] == "Π" and body[-1][1] == "_"
+        body = body[-1][-1]
+    assert body == ("Var", "x")
+
+def test_used_wildcards_are_renamed():
+    a = mk("Var", "a")
+    t = mk("Bind", "_", "_", mk("@", bind(("a",), a), mk("Idx", 1)))
+    named = from_nameless(t)
+    x, y = named[1:-1]
+    assert x != "_" and y == "_"
+    assert named[-1] == ("@", ("Bind", "a", ("Var", "a")), ("Var", x))
+    assert alpha(to_nameless(named), t)
+
+@pytest.mark.parametrize("source", [
+    "λ (x : U) (x : U) => x",
+    "λ (x : U) (y : U) (x : U) => y x",
+    "λ (x : U) (y : x) (x : y) => x",
+    "λ (x : U) => (λ (x : U) => x) x",
+])
+def test_shadowing_prints_unchanged(source):
+    assert pretty(parse_term(source)) == source
+
+@pytest.mark.parametrize("term", [
+    # The inner binder would capture the outer x, or the free x.
+    mk("λ", mk("U"), mk("Bind", "x", mk("λ", mk("U"), mk("Bind", "x", mk("Idx", 1))))),
+    mk("λ", mk("U"), mk("Bind", "x", mk("Var", "x"))),
+    # Hints of fresh variables are not valid names.
+    mk("λ", mk("U"), mk("Bind", "x#7", mk("λ", mk("Idx", 0), mk("Bind", "x#8",
+        mk("@", mk("Idx", 1), mk("Idx", 0)))))),
+])
+def test_renamed_binders_parse_back(term):
+    text = pretty(term)
+    assert "#" not in text and alpha(parse_term(text), term)
@@ -0,0 +1,61 @@
+import pytest
+from Core import alpha
+from Parser import LexError, file_parse, parse_term, pretty
+
+@pytest.mark.parametrize("source", ["a $ b", "U U $ U", "λ (x : U $) => x", "Id[x / p : a $ == b . U][a, b]"])
+def test_unexpected_character(source):
+    with pytest.raises(LexError, match=r"'\$'"):
+        parse_term(source)
+
+def test_unexpected_character_in_file():
+    with pytest.raises(LexError, match="line 1, column 12"):
+        list(file_parse("\\infer U U $ U\n\\infer U\n"))
+
+@pytest.mark.parametrize("source, message", [
+    ("f (x", "Expected '\\)', got end of input"),
+    ("U (U", "Expected '\\)', got end of input"),
+    ("f fst", "got end of input"),
+    ("", "Expected a term, got end of input"),
+    ("( )", "Expected a term, got '\\)' at line 1, column 3"),
+    ("λ (x : U) =>", "Expected a term"),
+])
+def test_incomplete_term(source, message):
+    with pytest.raises(RuntimeError, match=message):
+        parse_term(source)
+
+@pytest.mark.parametrize("source, message", [
+    ("\\infer U (U\n\\infer U\n", "Expected '\\)', got '\\\\infer' at line 2, column 1"),
+    ("\\define f", "Expected a term, got end of input"),
+])
+def test_incomplete_statement(source, message):
+    with pytest.raises(RuntimeError, match=message):
+        list(file_parse(source))
+
+def test_application_and_projections():
+    assert parse_term("f (x) y") == parse_term("(f x) y")
+    assert parse_term("f fst snd p q") == parse_term("(f (fst (snd p))) q")
+
+F5 = "F (F (F (F (F A))))"
+
+@pytest.mark.parametrize("source", [
+    "λ (A : U) (F : Π (x : U) => U) => G (%s) (%s)" % (F5, F5),
+    "λ (A : U) (F : Π (x : U) => U) (a : A) => G (%s) (λ (b : A) => "
+        "G (%s) (F (F (F (F b)))) (F (F (F (F b)))))" % (F5, F5),
+    "λ (A : U) (F : Π (x : U) => U) => s1 (%s) (%s)" % (F5, F5),
+    "λ (A : U) (F : Π (x : U) => U) (s1 : U) => s1 (%s) (%s)" % (F5, F5),
+    "λ (s1 : U) (s2 : U) (A : U) (F : Π (x : U) => U) => s1 (%s) (%s) s2" % (F5, F5),
+])
+@pytest.mark.parametrize("width", [None, 30])
+def test_let_round_trip(source, width):
+    t = parse_term(source)
+    text = pretty(t, width=width, share=True)
+    assert "let" in text
+    assert alpha(parse_term(text), t)
+
+def test_let():
+    assert parse_term("let x = U in λ (y : x) => x") == parse_term("λ (y : U) => U")
+    assert parse_term("λ (A : U) => let x = A in x") == parse_term("λ (A : U) => A")
+
+def test_normalize_statement():
+    (statement,) = file_parse("\\normalize λ (A : U) => A")
+    assert statement == ("\\normalize", parse_term("λ (A : U) => A"))
@@ -0,0 +1,56 @@
+import pytest
+from Core import mk
+from Checker import Checker, BUILTINS
+from Parser import file_parse, parse_term
+
+NAT = """
+\\constant Nat U
+\\constant zero Nat
+\\constant succ Π (n : Nat) => Nat
+\\constant plus Π (m : Nat) (n : Nat) => Nat
+\\rule plus-zero (n : Nat) => plus n zero = n
+\\rule plus-succ (m : Nat) (n : Nat) => plus m (succ n) = succ (plus m n)
+\\define two succ (succ zero)
+"""
+
+def checker(source, engine="subst"):
+    checker = Checker(dict(BUILTINS), engine)
+    for command in file_parse(source):
+        checker.execute(command)
+    return checker
+
+def con(term):
+    # The normal form of a term of constants, which normalize turns into cons.
+    return checker(NAT).normalize(parse_term(term))
+
+@pytest.mark.parametrize("engine", ["subst", "nbe"])
+def test_pattern_rules(engine):
+    c = checker(NAT, engine)
+    four = con("succ (succ (succ (succ zero)))")
+    assert c.normalize(parse_term("plus two two"), True) == four
+    assert c.normalize(parse_term("plus two two")) == con("plus two two")
+    assert c.rules.hits["plus-succ"] and c.rules.hits["plus-zero"]
+
+def test_rules_reduce_in_conversion():
+    c = checker(NAT)
+    c.infer(parse_term("λ (P : Π (n : Nat) => U) (p : P (succ (succ (succ zero)))) => "
+        "p { x => P (plus (succ zero) two) } p"))
+    assert not c.postponed and c.rules.hits["plus-succ"]
+
+def test_constant_rule():
+    c = checker(NAT + "\\constant one Nat\n\\rule one-succ => one = succ zero")
+    assert c.normalize(parse_term("plus two one")) == con("plus two (succ zero)")
+    assert c.whnf(parse_term("one"))[:2] == ("@", mk("con", "succ"))
+    assert c.rules.hits["one-succ"] == 2
+
+@pytest.mark.parametrize("rule, message", [
+    ("\\rule r (n : Nat) => zero = n", "does not occur"),
+    ("\\rule r (n : Nat) => n = zero", "cannot be a pattern variable"),
+    ("\\rule plus-zero => zero = zero", "already exists"),
+    ("\\rule r => two = zero", "must be a constant here: two"),
+])
+def test_bad_rules(rule, message):
+    c = checker(NAT)
+    with pytest.raises(ValueError, match=message):
+        for command in file_parse(rule):
+            c.execute(command)
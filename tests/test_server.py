@@ -0,0 +1,32 @@
+import Core
+from Server import Server
+
+POSTPONES = "λ (A : U) (B : U) (a : A) (f : Π (x : B) => U) => f ap[.a]"
+
+def call(server, method, **params):
+    return server.call({"jsonrpc" : "2.0", "id" : 1, "method" : method, "params" : params})
+
+def test_postponed_per_request():
+    server = Server()
+    for _ in range(3):
+        assert len(call(server, "infer", term=POSTPONES)["postponed"]) == 1
+        assert "postponed" not in call(server, "infer", term="Π (A : U) => A")
+    assert len(server.checker.postponed) == 0
+
+def test_tables_are_bounded():
+    answers = []
+    for max_nodes in (10**9, 0):
+        server = Server(max_nodes=max_nodes)
+        answers.append([
+            call(server, "define", name="id", term="λ (A : U) (a : A) => a")["type"],
+            call(server, "infer", term="id U")["type"],
+            call(server, "normalize", term="id U U", unfold=True)["term"],
+        ])
+    assert len(Core.interned) == 0
+    assert answers[0] == answers[1] == ["Π (A : U) (a : A) => A", "Π (a : U) => U", "U"]
+
+def test_load_results():
+    server = Server()
+    result = call(server, "load", source="\\define id λ (A : U) (a : A) => a\n"
+        "\\infer id U\n\\normalize (λ (A : U) (a : A) => a) U U\n")
+    assert result["results"] == ["Π (a : U) => U", "U"]
@@ -0,0 +1,59 @@
+import pytest
+from Core import mk
+from Checker import Checker, BUILTINS
+from Parser import file_parse, parse_term
+
+SOURCE = """
+\\constant Z U
+\\constant z Z
+\\constant w Z
+\\constant f Π (x : Z) => Z
+"""
+
+@pytest.fixture
+def checker():
+    checker = Checker(dict(BUILTINS))
+    for command in file_parse(SOURCE):
+        checker.execute(command)
+    return checker
+
+FZ = mk("@", mk("con", "f"), mk("con", "z"))  # Normal form of f z.
+
+def run(checker, source):
+    for command in file_parse(source):
+        checker.execute(command)
+
+@pytest.mark.parametrize("warm", [True, False])
+def test_snapshot_does_not_see_later_rules(checker, warm):
+    snapshot = checker.snapshot()
+    fz = parse_term("f z")
+    if warm:
+        checker.normalize(fz)
+    run(checker, "\\rule fz => f z = w")
+    assert checker.normalize(fz) == mk("con", "w")
+    assert checker.at(snapshot).normalize(fz) == FZ
+    checker.restore(snapshot)
+    assert checker.normalize(fz) == FZ
+
+def test_snapshot_does_not_see_later_definitions(checker):
+    snapshot = checker.snapshot()
+    run(checker, "\\define d z\n\\constant c Z")
+    assert checker.infer(mk("Var", "d")) == mk("Var", "Z")
+    for name in ("c", "d"):
+        with pytest.raises(ValueError, match="Unknown variable"):
+            checker.infer(mk("Var", name), snapshot)
+    assert checker.infer(parse_term("f z"), snapshot) == mk("Var", "Z")
+
+def test_push_def_restores(checker):
+    d = mk("Var", "d")
+    before = checker.normalize(d, True)
+    with checker.push_def({"d": parse_term("f z")}):
+        assert checker.normalize(d, True) == FZ
+    assert "d" not in checker.definitions
+    assert checker.normalize(d, True) == before == d
+
+def test_push_restores_context(checker):
+    with checker.push({"x": mk("Var", "Z")}):
+        snapshot = checker.snapshot()
+    assert "x" not in checker.context
+    assert checker.infer(mk("Var", "x"), snapshot) == mk("Var", "Z")